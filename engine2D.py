@@ -3,6 +3,10 @@ from urllib.parse import scheme_chars
 environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 
 import pygame
+import math
+import numpy as np
+
+from collections import OrderedDict
 
 from enum import IntEnum
 
@@ -24,10 +28,36 @@ pygame_window_caption = "engine2D application"
 
 input_array = [False] * 16
 
-# Array of active objects
-object_array = []
-# Array containing object ids that have to be destroyed
-destruction_queue = []
+# Registry of active objects, indexed by object id. Iterates in creation order.
+object_registry = {}
+# Snapshot of the active objects, rebuilt lazily by GetObjects() when the registry
+# changes, so that objects can be added or deleted while it is being iterated
+object_array = ()
+object_array_stale = False
+# Set containing object ids that have to be destroyed
+destruction_queue = set()
+
+# Input event dispatch tables. For each handler, the enabled objects whose class
+# overrides it, indexed by object id. The snapshots are rebuilt lazily in
+# creation order by _GetSubscribers() when the subscribers change.
+EVENT_HANDLERS = ("OnKeyPress", "OnKeyPressed", "OnKeyRelease", "OnTextInput", "OnMouseMove")
+event_subscribers = {handler: {} for handler in EVENT_HANDLERS}
+event_subscriber_snapshots = {}
+
+# Spatial index of the objects, a uniform grid of square cells of spatial_cell_size
+# pixels, refreshed from the bounds of the objects by UpdateSpatialIndex()
+# spatial_cells - (column, row) -> set of the ids of the objects touching the cell
+# spatial_entries - id -> (bounds, cells) the object is indexed with
+# unbounded_objects - ids of the objects without bounds (or spanning more than
+# SPATIAL_MAX_CELLS cells), which are in every query
+spatial_cell_size = 64
+SPATIAL_MAX_CELLS = 4096
+spatial_cells = {}
+spatial_entries = {}
+unbounded_objects = set()
+# Ids of the OnMouseMove listeners that were under the mouse at its last move
+mouse_hover_ids = ()
+
 # Total number of objects being created. Used for assigning IDs.
 object_counter = 0
 
@@ -35,6 +65,35 @@ object_counter = 0
 default_viewport = None
 current_viewport = None
 
+# Dirty rectangle rendering -- when enabled, only the regions of the screen
+# touched by objects that called MarkDirty() are redrawn and pushed to the display
+dirty_rect_mode = False
+# Screen rectangles damaged outside of any object (deleted objects, Invalidate())
+damaged_rects = []
+
+# Power saving -- when enabled, the loop sleeps until an input event arrives or
+# an object needs to be updated, and skips rendering when nothing has changed
+power_saving_mode = False
+
+# LRU cache of the flipped, translucent and rotated surfaces drawn by DrawImage,
+# indexed by (source surface, horizontal flip, vertical flip, opacity, angle, smooth)
+transform_cache = OrderedDict()
+transform_cache_size = 512
+transform_cache_bytes = 32*1024*1024
+transform_cache_bytes_used = 0
+transform_cache_hits = 0
+transform_cache_misses = 0
+# Angles are rounded to multiples of this many degrees before rotating, so that
+# the rotated surfaces can be reused. 0 to rotate by the exact angle.
+rotation_step = 1
+
+# LRU cache of the translucent surfaces drawn by DrawBlock,
+# indexed by (w, h, colour, opacity, filled, linewidth)
+block_cache = OrderedDict()
+block_cache_size = 64
+block_cache_bytes = 16*1024*1024
+block_cache_bytes_used = 0
+
 class Button(IntEnum):
     UP = 0
     DOWN = 1
@@ -76,9 +135,14 @@ class Viewport:
     def IsInView(self, x, y):
         vp_x, vp_y = self.ToScreen(x, y)
         if(vp_x < 0 or vp_y < 0): return False
-        if(vp_x >= self.w and vp_y >= self.h): return False
+        if(vp_x >= self.w or vp_y >= self.h): return False
         return True
 
+    # Returns whether any part of the rectangle (x, y, w, h) is in view
+    def IsRectInView(self, x, y, w, h):
+        vp_x, vp_y = self.ToScreen(x, y)
+        return vp_x < self.w and vp_y < self.h and vp_x + w > 0 and vp_y + h > 0
+
 class TileSet:
     def __init__(self, filename, tilesize_w, tilesize_h, columns):
         self.image = Image(filename)
@@ -116,21 +180,76 @@ class Font:
     def PutString(self, s, x, y):
         pass
 
+    # Draws many strings at once
+    # strings - sequence of (s, x, y) tuples
+    def PutStrings(self, strings):
+        for s, x, y in strings:
+            self.PutString(s, x, y)
+
+    # Renders a string into a new surface, for callers that cache text themselves
+    # Returns None if the font cannot render off-screen
+    def RenderString(self, s):
+        return None
+
+# color - default text colour
+# cache_size - maximum number of rendered strings kept
+# cache_bytes - maximum memory used by the rendered strings kept
 class TrueTypeFont(Font):
-    def __init__(self, filename, font_size, font_width, antialias=True):
+    def __init__(self, filename, font_size, font_width, antialias=True, color=(255, 255, 255), cache_size=256, cache_bytes=8*1024*1024):
         self.ch_h = font_size
         self.ch_w = font_width
         self.antialias = antialias
+        self.color = tuple(color)
         self.ttf_font = pygame.font.Font(filename, font_size)
+
+        # LRU cache of rendered strings, indexed by (text, colour, antialias)
+        self.render_cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.cache_bytes_used = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
     
-    def PutString(self, s, x, y):
-        screen_surface.blit(self.ttf_font.render(s, self.antialias, (255, 255, 255)), (x,y))
+    # Returns the rendered surface of a string, rasterising it only if it is not cached
+    def Render(self, s, color=None):
+        key = (s, self.color if color == None else tuple(color), self.antialias)
+        surface = self.render_cache.get(key)
+        if(surface != None):
+            self.cache_hits += 1
+            self.render_cache.move_to_end(key)
+            return surface
+        
+        self.cache_misses += 1
+        surface = self.ttf_font.render(s, self.antialias, key[1])
+        self.render_cache[key] = surface
+        self.cache_bytes_used += surface.get_pitch() * surface.get_height()
+
+        # Evict the least recently used strings
+        while(len(self.render_cache) > 1 and (len(self.render_cache) > self.cache_size or self.cache_bytes_used > self.cache_bytes)):
+            _, evicted = self.render_cache.popitem(last=False)
+            self.cache_bytes_used -= evicted.get_pitch() * evicted.get_height()
+        
+        return surface
+
+    def RenderString(self, s):
+        return self.ttf_font.render(s, self.antialias, self.color)
+
+    def ClearCache(self):
+        self.render_cache.clear()
+        self.cache_bytes_used = 0
     
-    def PutChar(self, c, x, y):
-        self.PutString(c, x, y)
+    def PutString(self, s, x, y, color=None):
+        screen_surface.blit(self.Render(s, color), (x,y))
+    
+    def PutChar(self, c, x, y, color=None):
+        self.PutString(c, x, y, color)
+
+    def PutStrings(self, strings, color=None):
+        screen_surface.blits([(self.Render(s, color), (x, y)) for s, x, y in strings], False)
 
 class BitmapFont(Font):
-    def __init__(self, filename, ch_w, ch_h, colorkey_r=0, colorkey_g=0, colorkey_b=0, ch_offset=0, font_scale=1): 
+    # run_cache_size - maximum number of rendered strings kept by PutString
+    def __init__(self, filename, ch_w, ch_h, colorkey_r=0, colorkey_g=0, colorkey_b=0, ch_offset=0, font_scale=1, run_cache_size=256): 
         self.image = Image(filename)
         self.image = MakeTransparentImage(self.image, colorkey_r, colorkey_g, colorkey_b)
         self.image = ResizeImage(self.image, font_scale * self.image.w, font_scale * self.image.h)
@@ -145,6 +264,16 @@ class BitmapFont(Font):
         for i in range(0, self.total_chars):
             new_surface = self.image.image_data.subsurface((int(i % self.columns) * self.ch_w, int(i / self.columns) * self.ch_h, self.ch_w, self.ch_h))
             self.characters[i] = Image("", self.ch_w, self.ch_h, new_surface)
+        
+        # Glyphs that are completely transparent (e.g. space) are skipped when drawing
+        self.empty_characters = [c.image_data.get_bounding_rect().w == 0 for c in self.characters]
+        # Drawn in place of characters not in the font
+        self.missing_character = pygame.Surface((self.ch_w, self.ch_h))
+        self.missing_character.fill((255, 0, 0))
+
+        # LRU cache of whole strings rendered into a single image, indexed by string
+        self.run_cache = OrderedDict()
+        self.run_cache_size = run_cache_size
     
     def PutChar(self, c, x, y):
         if(ord(c) - self.ch_offset < len(self.characters) and (ord(c) - self.ch_offset) >= 0):
@@ -152,9 +281,61 @@ class BitmapFont(Font):
         else:
             DrawBlock(x, y, self.ch_w, self.ch_h, 255, 0, 0, True)
     
+    # Renders a string into a single transparent surface
+    def RenderString(self, s):
+        surface = pygame.Surface((len(s) * self.ch_w, self.ch_h), pygame.SRCALPHA)
+        surface.blits(self._GlyphBlits(s, 0, 0), False)
+        return surface
+
+    def _RenderRun(self, s):
+        surface = self.RenderString(s)
+        run = Image("", 0, 0, surface)
+        run.w = surface.get_width()
+        run.h = surface.get_height()
+        return run
+
     def PutString(self, s, x, y):
-        for i in range(0, len(s)):
-            self.PutChar(s[i], x+i*(self.ch_w), y)
+        if(s == ""):
+            return
+        
+        # Strings are rendered once and then drawn with a single blit
+        run = self.run_cache.get(s)
+        if(run == None):
+            run = self._RenderRun(s)
+            self.run_cache[s] = run
+            if(len(self.run_cache) > self.run_cache_size):
+                self.run_cache.popitem(last=False)
+        else:
+            self.run_cache.move_to_end(s)
+        
+        DrawImage(run, x, y)
+
+    # Returns the (surface, position) blit sequence for the glyphs of a string
+    # drawn at the screen position (x, y)
+    def _GlyphBlits(self, s, x, y):
+        blit_sequence = []
+        for i, c in enumerate(s):
+            idx = ord(c) - self.ch_offset
+            if(idx < len(self.characters) and idx >= 0):
+                if(not self.empty_characters[idx]):
+                    blit_sequence.append((self.characters[idx].image_data, (round(x + i * self.ch_w), round(y))))
+            else:
+                blit_sequence.append((self.missing_character, (round(x + i * self.ch_w), round(y))))
+        return blit_sequence
+
+    # Draws many strings with a single Surface.blits call. Strings already in the
+    # run cache are drawn as one image, others glyph by glyph (without being cached).
+    def PutStrings(self, strings):
+        blit_sequence = []
+        for s, x, y in strings:
+            x, y = current_viewport.ToScreen(x, y)
+            run = self.run_cache.get(s)
+            if(run != None):
+                blit_sequence.append((run.image_data, (round(x), round(y))))
+            else:
+                blit_sequence += self._GlyphBlits(s, x, y)
+        
+        screen_surface.blits(blit_sequence, False)
 
 class Object:
     def __init__(self):
@@ -168,27 +349,57 @@ class Object:
         self.id = 0
         self.hidden = False
         self.disabled = False
+
+        # Dirty rectangle tracking, dirty objects are redrawn on the next frame
+        # drawn_bounds is the screen rectangle the object occupied when last drawn
+        self.dirty = True
+        self.drawn_bounds = None
     
     def __del__(self):
         pass
 
+    # Returns the (x, y, w, h) rectangle the object draws into, or None if
+    # unknown, in which case the object is assumed to cover the whole screen
+    def GetBounds(self):
+        if(hasattr(self, 'w') and hasattr(self, 'h')):
+            return (self.x, self.y, self.w, self.h)
+        return None
+
+    # Must be called whenever something that changes the object's appearance changes
+    def MarkDirty(self):
+        self.dirty = True
+
+    # Returns the time in milliseconds until Update() next has work to do,
+    # 0 if it has to run every frame, or None if it never has to run.
+    # Used by the power saving mode to decide how long the loop may sleep.
+    def NextUpdate(self):
+        if(type(self).Update != Object.Update):
+            return 0
+        return None
+
     def Disable(self):
         self.disabled = True
+        if(GetObject(self.id) is self):
+            _UnsubscribeEvents(self)
     
     def Enable(self):
         self.disabled = False
+        if(GetObject(self.id) is self):
+            _SubscribeEvents(self)
     
     def Hide(self):
         self.hidden = True
+        self.MarkDirty()
     
     def DisableAllExceptMe(self):
-        for i in range(len(object_array)):
-            object_array[i].Disable()
+        for object in GetObjects():
+            object.Disable()
         
         self.Enable()
 
     def Show(self):
         self.hidden = False
+        self.MarkDirty()
     
     def Delete(self):
         DeleteObject(self.id)
@@ -224,6 +435,8 @@ class Image:
     image_data = 0
     w = 0 
     h = 0
+    # Precomputed transformed surfaces, indexed like transform_cache without the source surface
+    rotations = None
 
     def __init__(self, file, w=0, h=0, image_data=0):
         if(not image_data):
@@ -269,6 +482,129 @@ class Sprite:
     def GetFrame(self, idx):
         return self.sprite_frames[idx]
 
+    # Rotates every frame by every multiple of step degrees ahead of time, so that
+    # drawing the sprite rotated never rotates a surface. Costs 360 / step surfaces per frame.
+    # step - defaults to rotation_step, or 1 degree if angles are not rounded (rotation_step = 0)
+    def PrecomputeRotations(self, step=None, smooth=False, horiz_flip=False, vert_flip=False, opacity=255):
+        if(step == None):
+            step = rotation_step if rotation_step > 0 else 1
+        if(step <= 0):
+            raise ValueError("step must be positive")
+        for frame in self.sprite_frames:
+            if(frame.rotations == None):
+                frame.rotations = {}
+            for i in range(1, int(360 / step)):
+                angle = _QuantizeAngle(i * step)
+                frame.rotations[(horiz_flip, vert_flip, opacity, angle, smooth)] = _Transform(frame.image_data, horiz_flip, vert_flip, opacity, angle, smooth)
+
+# Region of a TextureAtlas page, used like any Image
+# page - the atlas surface holding the pixels
+# rect - where the pixels are in the page
+# image_data is a subsurface of the page, so the region owns no pixels of its own
+class AtlasRegion(Image):
+    def __init__(self, page, rect):
+        self.page = page
+        self.rect = rect
+        self.image_data = page.subsurface(rect)
+        self.w = rect.w
+        self.h = rect.h
+
+# Texture atlas
+# Packs many images into a few large surfaces (pages) with shelf packing:
+# images are placed left to right on shelves stacked from the top of a page,
+# each image going on the lowest shelf it fits on. A new shelf is opened when
+# none fits, and a new page when there is no room left for a shelf.
+# Images larger than a page get a page of their own.
+class TextureAtlas:
+    def __init__(self, page_w=1024, page_h=1024):
+        self.page_w = page_w
+        self.page_h = page_h
+        self.pages = []
+        # For every page, its shelves as [y, height, used width]
+        self.shelves = []
+        self.used_pixels = 0
+    
+    def _NewPage(self, w, h):
+        page = pygame.Surface((w, h), pygame.SRCALPHA).convert_alpha()
+        page.fill((0, 0, 0, 0))
+        self.pages.append(page)
+        self.shelves.append([])
+        return len(self.pages) - 1
+    
+    # Finds room for a w x h image, returns (page index, x, y)
+    def _Allocate(self, w, h):
+        if(w > self.page_w or h > self.page_h):
+            page_index = self._NewPage(w, h)
+            self.shelves[page_index].append([0, h, w])
+            return page_index, 0, 0
+        
+        # The lowest shelf with room left
+        best = None
+        for page_index, shelves in enumerate(self.shelves):
+            page_w = self.pages[page_index].get_width()
+            for shelf in shelves:
+                if(h <= shelf[1] and shelf[2] + w <= page_w and (best == None or shelf[1] < best[1][1])):
+                    best = (page_index, shelf)
+        if(best != None):
+            page_index, shelf = best
+            x = shelf[2]
+            shelf[2] += w
+            return page_index, x, shelf[0]
+        
+        # Open a new shelf on the first page with room for it
+        for page_index, shelves in enumerate(self.shelves):
+            top = shelves[-1][0] + shelves[-1][1] if shelves else 0
+            if(top + h <= self.pages[page_index].get_height() and w <= self.pages[page_index].get_width()):
+                shelves.append([top, h, w])
+                return page_index, 0, top
+        
+        page_index = self._NewPage(self.page_w, self.page_h)
+        self.shelves[page_index].append([0, h, w])
+        return page_index, 0, 0
+
+    # Copies an image into the atlas and returns its AtlasRegion
+    def Add(self, img):
+        surface = img.image_data
+        w, h = surface.get_size()
+        page_index, x, y = self._Allocate(w, h)
+        page = self.pages[page_index]
+
+        # The colour key and the surface alpha become per-pixel alpha in the page
+        alpha = surface.get_alpha()
+        converted = surface.convert_alpha()
+        converted.set_alpha(255)
+        if(alpha != None and alpha != 255):
+            converted.fill((255, 255, 255, alpha), special_flags=pygame.BLEND_RGBA_MULT)
+        # The page is transparent there, so this copies the pixels as they are
+        page.blit(converted, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+        
+        self.used_pixels += w * h
+        return AtlasRegion(page, pygame.Rect(x, y, w, h))
+
+    # Adds many images at once, tallest first, which packs them tighter than adding them
+    # one by one. Returns their regions in the same order as the images.
+    def AddImages(self, images):
+        regions = [None] * len(images)
+        order = sorted(range(len(images)), key=lambda i: (images[i].image_data.get_height(), images[i].image_data.get_width()), reverse=True)
+        for i in order:
+            regions[i] = self.Add(images[i])
+        return regions
+    
+    # Move the images of a Sprite, TileSet or BitmapFont into the atlas
+    # The source sheet of a TileSet or BitmapFont (its image) is only needed to slice it,
+    # so it is dropped to keep only the atlas copy of the pixels.
+    # Note: pack a Sprite before calling its PrecomputeRotations()
+    def AddSprite(self, spr):
+        spr.sprite_frames = self.AddImages(spr.sprite_frames)
+    
+    def AddTileSet(self, tileset):
+        tileset.tiles = [tileset.tiles[0]] + self.AddImages(tileset.tiles[1:])
+        tileset.image = None
+    
+    def AddFont(self, font):
+        font.characters = self.AddImages(font.characters)
+        font.image = None
+
 # Animation player object
 # Create an animation player using a sprite
 # Then add animations to it
@@ -295,14 +631,20 @@ class AnimationPlayer(Object):
             if(self.timer >= self.animations[self.playing_animation_key][1]):
                 self.timer = 0
                 self.current_frame += 1
+                self.MarkDirty()
                 if(self.current_frame >= len(self.animations[self.playing_animation_key][0])):
                     if(self.is_looping):
                         self.current_frame = 0
                     else:
                         self.StopAnimation()
     
-    def DrawAnimation(self, x, y, pivotx=0, pivoty=0, angle=0, horiz_flip=False, vert_flip=False):
-        DrawSprite(self.sprite, self.animations[self.playing_animation_key][0][self.current_frame], x, y, pivotx, pivoty, angle, horiz_flip, vert_flip)
+    def NextUpdate(self):
+        if(not self.is_playing):
+            return None
+        return max((self.animations[self.playing_animation_key][1] - self.timer) * 1000, 0)
+
+    def DrawAnimation(self, x, y, pivotx=0, pivoty=0, angle=0, horiz_flip=False, vert_flip=False, smooth=False):
+        DrawSprite(self.sprite, self.animations[self.playing_animation_key][0][self.current_frame], x, y, pivotx, pivoty, angle, horiz_flip, vert_flip, smooth)
 
     def StopAnimation(self):
         self.is_playing = False
@@ -312,6 +654,7 @@ class AnimationPlayer(Object):
         self.timer = 0
 
     def PlayAnimation(self, animation_key, is_looping):
+        self.MarkDirty()
         self.is_playing = True
         self.is_looping = is_looping
         self.playing_animation_key = animation_key
@@ -335,44 +678,85 @@ class Timer(Object):
         self.disabled = True
     
     def Start(self):
-        self.disabled = False
+        self.Enable()
     
     def Update(self, elapsed):
         self.timer += elapsed
         if(self.timer >= self.interval):
             self.timer = 0
-            self.disabled = True
+            self.Disable()
             self.timer_callback(self.id)
 
+    def NextUpdate(self):
+        return max(self.interval - self.timer, 0)
+
+
+# Whether the object handles the given input event, i.e. its class (or the
+# object itself) overrides the no-op handler of Object
+def _HandlesEvent(obj, handler):
+    return handler in obj.__dict__ or getattr(type(obj), handler) is not getattr(Object, handler)
+
+def _SubscribeEvents(obj):
+    for handler in EVENT_HANDLERS:
+        if(_HandlesEvent(obj, handler) and obj.id not in event_subscribers[handler]):
+            event_subscribers[handler][obj.id] = obj
+            event_subscriber_snapshots.pop(handler, None)
+
+def _UnsubscribeEvents(obj):
+    for handler in EVENT_HANDLERS:
+        if(obj.id in event_subscribers[handler]):
+            del event_subscribers[handler][obj.id]
+            event_subscriber_snapshots.pop(handler, None)
+
+# Returns the objects listening to the given handler, in creation order
+def _GetSubscribers(handler):
+    snapshot = event_subscriber_snapshots.get(handler)
+    if(snapshot == None):
+        snapshot = tuple(obj for id, obj in sorted(event_subscribers[handler].items()))
+        event_subscriber_snapshots[handler] = snapshot
+    return snapshot
 
 def events_onkeypress(elapsed, key):
-    for object in object_array:
+    for object in _GetSubscribers("OnKeyPress"):
         if(not object.disabled):
             object.OnKeyPress(elapsed, key)
 
 def events_onkeypressed(elapsed, key):
-    for object in object_array:
+    for object in _GetSubscribers("OnKeyPressed"):
         if(not object.disabled):
             object.OnKeyPressed(elapsed, key)
 
 def events_onkeyrelease(elapsed, key):
-    for object in object_array:
+    for object in _GetSubscribers("OnKeyRelease"):
         if(not object.disabled):
             object.OnKeyRelease(elapsed, key)
 
 def events_ontextinput(elapsed, c):
-    for object in object_array:
+    for object in _GetSubscribers("OnTextInput"):
         if(not object.disabled):
             object.OnTextInput(elapsed, c)
         
+# Mouse moves only go to the objects under the mouse, and to the ones it just left
+# so that they can notice it leaving
 def events_onmousemove(elapsed, x, y):
-    for object in object_array:
-        if(not object.disabled):
-            object.OnMouseMove(elapsed, current_viewport.FromScreen(x, y)[0], current_viewport.FromScreen(x, y)[1])
-
-def ProcessEvents(elapsed):
-    # Get inputs
-    for event in pygame.event.get():
+    global mouse_hover_ids
+    x, y = current_viewport.FromScreen(x, y)
+    subscribers = event_subscribers["OnMouseMove"]
+    hover_ids = [object.id for object in QueryPoint(x, y) if object.id in subscribers]
+    ids = sorted(set(hover_ids).union(mouse_hover_ids))
+    mouse_hover_ids = hover_ids
+
+    for id in ids:
+        object = subscribers.get(id)
+        if(object != None and not object.disabled):
+            object.OnMouseMove(elapsed, x, y)
+
+def ProcessEvents(elapsed, pending_events=None):
+    if(pending_events == None):
+        pending_events = []
+    
+    # Get inputs, including those already taken off the queue by the loop
+    for event in pending_events + pygame.event.get():
         
         if event.type == pygame.QUIT:
             return False
@@ -417,22 +801,225 @@ def ProcessEvents(elapsed):
             if event.button == pygame.BUTTON_RIGHT:  events_onkeyrelease(elapsed, Button.MOUSE2); input_array[Button.MOUSE2] = False
     
     
-    for idx, i in enumerate(input_array):
-        if i == True:
-            events_onkeypressed(elapsed, idx)
+    # Held keys are only dispatched if somebody is listening to them
+    if(_GetSubscribers("OnKeyPressed")):
+        for idx, i in enumerate(input_array):
+            if i == True:
+                events_onkeypressed(elapsed, idx)
         
     return True
 
 
+# Converts an object's bounds into a screen rectangle for dirty rectangle tracking
+# Bounds are padded by a pixel to account for rounding and anti-aliased edges
+def _BoundsToScreenRect(bounds):
+    if(bounds == None):
+        return pygame.Rect(0, 0, screen_width, screen_height)
+    x, y = current_viewport.ToScreen(bounds[0], bounds[1])
+    return pygame.Rect(math.floor(x) - 1, math.floor(y) - 1, math.ceil(bounds[2]) + 3, math.ceil(bounds[3]) + 3)
+
+# Clips rectangles to the screen and merges the overlapping ones so that
+# no region is redrawn twice
+def _MergeRects(rects):
+    screen_rect = pygame.Rect(0, 0, screen_width, screen_height)
+    merged = []
+    for rect in rects:
+        rect = rect.clip(screen_rect)
+        if(rect.w == 0 or rect.h == 0):
+            continue
+        idx = rect.collidelist(merged)
+        while(idx != -1):
+            rect.union_ip(merged.pop(idx))
+            idx = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+# Collects the screen regions damaged since the last frame, and updates
+# the drawn bounds of the dirty objects
+def _CollectDirtyRects():
+    global damaged_rects
+    rects = damaged_rects
+    damaged_rects = []
+
+    for object in GetObjects():
+        if(object.dirty):
+            # The old position has to be erased, and the new one drawn
+            if(object.drawn_bounds != None):
+                rects.append(object.drawn_bounds)
+            
+            if(object.hidden):
+                object.drawn_bounds = None
+            else:
+                object.drawn_bounds = _BoundsToScreenRect(object.GetBounds())
+                rects.append(object.drawn_bounds)
+            
+            object.dirty = False
+    
+    return _MergeRects(rects)
+
+# Redraws only the objects that intersect the damaged rectangles, clipped to them
+def _DrawDirtyRects(elapsed, rects):
+    for rect in rects:
+        screen_surface.set_clip(rect)
+        Clear(0,0,0)
+        for object in GetObjects():
+            if(not object.hidden and object.drawn_bounds != None and rect.colliderect(object.drawn_bounds)):
+                object.Draw(elapsed)
+    
+    screen_surface.set_clip(None)
+
+# Returns whether anything has to be redrawn on the next frame
+def _IsScreenDirty():
+    if(damaged_rects != []):
+        return True
+    for object in GetObjects():
+        if(object.dirty):
+            return True
+    return False
+
+# Computes how long (in milliseconds) the loop may sleep before an object
+# needs to be updated. None means it may sleep until the next input event.
+def _NextWakeup():
+    if(destruction_queue or True in input_array or _IsScreenDirty()):
+        return 0
+    
+    timeout = None
+    for object in GetObjects():
+        if(not object.disabled):
+            next_update = object.NextUpdate()
+            if(next_update != None and (timeout == None or next_update < timeout)):
+                timeout = next_update
+    
+    return timeout
+
+# Enables or disables the power saving mode
+# In this mode the loop blocks on pygame.event.wait() until the next input event,
+# Timer deadline or animation frame, and does not render frames in which no object
+# called MarkDirty(). Mouse motion events are enabled to wake the loop up.
+def SetPowerSavingMode(enabled):
+    global power_saving_mode
+    power_saving_mode = enabled
+    if(enabled):
+        pygame.event.set_allowed(pygame.MOUSEMOTION)
+    else:
+        pygame.event.set_blocked(pygame.MOUSEMOTION)
+    Invalidate()
+
+# Enables or disables dirty rectangle rendering
+# In this mode the screen is not cleared every frame, objects must call
+# MarkDirty() whenever their appearance changes
+def SetDirtyRectMode(enabled):
+    global dirty_rect_mode
+    dirty_rect_mode = enabled
+    Invalidate()
+
+# Forces a full redraw on the next frame in dirty rectangle mode
+# (e.g. after changing the viewport)
+def Invalidate():
+    damaged_rects.append(pygame.Rect(0, 0, screen_width, screen_height))
+
+# Returns the grid cells (first column, first row, last column, last row) covered by a rectangle
+def _CellRange(x, y, w, h):
+    return (math.floor(x / spatial_cell_size), math.floor(y / spatial_cell_size), math.floor((x + w) / spatial_cell_size), math.floor((y + h) / spatial_cell_size))
+
+def _IndexObject(obj, bounds):
+    cells = ()
+    if(bounds == None):
+        unbounded_objects.add(obj.id)
+    else:
+        c0, r0, c1, r1 = _CellRange(*bounds)
+        if((c1 - c0 + 1) * (r1 - r0 + 1) > SPATIAL_MAX_CELLS):
+            unbounded_objects.add(obj.id)
+        else:
+            cells = tuple((c, r) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1))
+            for cell in cells:
+                if(cell not in spatial_cells):
+                    spatial_cells[cell] = set()
+                spatial_cells[cell].add(obj.id)
+    
+    spatial_entries[obj.id] = (bounds, cells)
+
+def _UnindexObject(id):
+    entry = spatial_entries.pop(id, None)
+    if(entry == None):
+        return
+    
+    unbounded_objects.discard(id)
+    for cell in entry[1]:
+        ids = spatial_cells[cell]
+        ids.discard(id)
+        if(not ids):
+            del spatial_cells[cell]
+
+# Re-indexes the objects whose bounds changed since the last call
+# Called by the loop every frame after updating the objects, call it to query
+# objects moved since then
+def UpdateSpatialIndex():
+    for object in GetObjects():
+        bounds = object.GetBounds()
+        entry = spatial_entries.get(object.id)
+        if(entry != None and entry[0] == bounds):
+            continue
+        _UnindexObject(object.id)
+        _IndexObject(object, bounds)
+
+def SetSpatialCellSize(size):
+    global spatial_cell_size
+    spatial_cell_size = size
+    for id in list(spatial_entries):
+        _UnindexObject(id)
+    UpdateSpatialIndex()
+
+# Returns the objects with the given ids in creation order, with the objects without bounds
+def _IndexedObjects(ids):
+    ids = ids.union(unbounded_objects)
+    objects = []
+    for id in sorted(ids):
+        object = object_registry.get(id)
+        if(object != None):
+            objects.append(object)
+    return objects
+
+# Returns the objects whose bounds contain the point (x, y), in creation order.
+# Objects without bounds are assumed to cover everything, and are always returned.
+def QueryPoint(x, y):
+    ids = set()
+    for id in spatial_cells.get((math.floor(x / spatial_cell_size), math.floor(y / spatial_cell_size)), ()):
+        bx, by, bw, bh = spatial_entries[id][0]
+        if(bx <= x < bx + bw and by <= y < by + bh):
+            ids.add(id)
+    return _IndexedObjects(ids)
+
+# Returns the objects whose bounds intersect the rectangle (x, y, w, h), in creation order.
+# Objects without bounds are assumed to cover everything, and are always returned.
+def QueryRect(x, y, w, h):
+    c0, r0, c1, r1 = _CellRange(x, y, w, h)
+    if((c1 - c0 + 1) * (r1 - r0 + 1) <= len(spatial_cells)):
+        cells = [spatial_cells[cell] for cell in ((c, r) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1)) if cell in spatial_cells]
+    else:
+        # Large rectangles -- visit only the occupied cells
+        cells = [ids for (c, r), ids in spatial_cells.items() if c0 <= c <= c1 and r0 <= r <= r1]
+    
+    ids = set()
+    for cell in cells:
+        for id in cell:
+            if(id in ids):
+                continue
+            bx, by, bw, bh = spatial_entries[id][0]
+            if(bx < x + w and by < y + h and bx + bw > x and by + bh > y):
+                ids.add(id)
+    return _IndexedObjects(ids)
+
 def Loop(fps):
     global screen_surface, screen_width, screen_height, pygame_clock, pygame_window
-    global destruction_queue, object_array
+    global object_array_stale, damaged_rects
     
     pygame_clock = pygame.time.Clock()
     old_ticks = pygame.time.get_ticks()
     elapsed = 0
     mouse_x, mouse_y = pygame.mouse.get_pos()
     running = True
+    pending_events = []
     pygame.display.set_caption(pygame_window_caption)
 
     while running:
@@ -442,34 +1029,46 @@ def Loop(fps):
         old_ticks = new_ticks
         
         # Destroy objects queued for destruction
-        if(destruction_queue != []):
-            new_object_array = []
-            for object in object_array:
-                destroyed = False
-                for destroyed_id in destruction_queue:
-                    if(object.id == destroyed_id):
-                        destroyed = True
-
-                if(not destroyed):
-                    new_object_array.append(object)
+        if(destruction_queue):
+            for destroyed_id in destruction_queue:
+                object = object_registry.pop(destroyed_id, None)
+                if(object == None):
+                    continue
+                
+                _UnsubscribeEvents(object)
+                _UnindexObject(destroyed_id)
+                if(object.drawn_bounds != None):
+                    # Erase the destroyed object from the screen
+                    damaged_rects.append(object.drawn_bounds)
             
-            object_array = new_object_array
+            object_array_stale = True
             # Reset destruction queue
-            destruction_queue = []
+            destruction_queue.clear()
 
         # Update Objects
-        for object in object_array:
+        for object in GetObjects():
             if(not object.disabled):
                 object.Update(elapsed)
+        UpdateSpatialIndex()
         
-        # Clear Screen
-        Clear(0,0,0)
-    
-        for object in object_array:
-            if(not object.hidden):
-                object.Draw(elapsed)
+        # In power saving mode, frames in which nothing changed are not rendered
+        should_render = (not power_saving_mode) or _IsScreenDirty()
+
+        if(dirty_rect_mode):
+            # Only redraw what has changed
+            update_rects = _CollectDirtyRects()
+            _DrawDirtyRects(elapsed, update_rects)
+        elif(should_render):
+            # Clear Screen
+            Clear(0,0,0)
+        
+            # Only draw the objects in view
+            for object in QueryRect(current_viewport.x, current_viewport.y, current_viewport.w, current_viewport.h):
+                if(not object.hidden):
+                    object.Draw(elapsed)
 
-        running = ProcessEvents(elapsed)
+        running = ProcessEvents(elapsed, pending_events)
+        pending_events = []
 
         # Process mouse coordinates
         new_mouse_x, new_mouse_y = pygame.mouse.get_pos()
@@ -478,12 +1077,40 @@ def Loop(fps):
             mouse_y = new_mouse_y
             events_onmousemove(elapsed, new_mouse_x, new_mouse_y)
 
-        if(pygame_window):
-            pygame_window.blit(pygame.transform.scale(screen_surface, (pygame_windowWidth, pygame_windowHeight)), [0,0,pygame_windowWidth, pygame_windowHeight])
-
-        # Update to screen
-        pygame.display.flip()
-        pygame_clock.tick(fps)
+        if(dirty_rect_mode):
+            # Push only the damaged regions to the screen, nothing at all if the screen is idle
+            if(update_rects != []):
+                if(pygame_window):
+                    pygame_window.blit(pygame.transform.scale(screen_surface, (pygame_windowWidth, pygame_windowHeight)), [0,0,pygame_windowWidth, pygame_windowHeight])
+                    # Scale the damaged regions to the window
+                    sx = pygame_windowWidth / screen_width
+                    sy = pygame_windowHeight / screen_height
+                    update_rects = [pygame.Rect(math.floor(r.x * sx), math.floor(r.y * sy), math.ceil(r.w * sx) + 1, math.ceil(r.h * sy) + 1) for r in update_rects]
+                pygame.display.update(update_rects)
+        elif(should_render):
+            # Clear the dirty flags, they are tracked by _CollectDirtyRects() otherwise
+            for object in GetObjects():
+                object.dirty = False
+            damaged_rects = []
+
+            if(pygame_window):
+                pygame_window.blit(pygame.transform.scale(screen_surface, (pygame_windowWidth, pygame_windowHeight)), [0,0,pygame_windowWidth, pygame_windowHeight])
+
+            # Update to screen
+            pygame.display.flip()
+        
+        timeout = _NextWakeup() if (power_saving_mode and running) else 0
+        if(timeout == None or timeout > 1000 / fps):
+            # Nothing to do for a while, sleep until the next input event or deadline
+            if(timeout == None):
+                event = pygame.event.wait()
+            else:
+                event = pygame.event.wait(math.ceil(timeout))
+            if(event.type != pygame.NOEVENT):
+                pending_events.append(event)
+            pygame_clock.tick()
+        else:
+            pygame_clock.tick(fps)
 
 def IsPressed(key):
     return input_array[key]
@@ -512,18 +1139,109 @@ def SetRenderTarget(target):
     else:
         screen_surface = target.render_surface
 
+def GetViewport():
+    return current_viewport
+
+# Sets the viewport the drawing functions transform coordinates with
+# None restores the default viewport (the whole screen)
+def SetViewport(viewport):
+    global current_viewport
+    if(viewport == None):
+        current_viewport = default_viewport
+    else:
+        current_viewport = viewport
+
 def DrawPixel(x, y, r, g, b):
     x, y = current_viewport.ToScreen(x, y)
     screen_surface.set_at((int(x), int(y)), pygame.Color((int(r), int(g), int(b))))
 
+# Bulk drawing -- the Draw*s functions below draw many primitives given as NumPy
+# arrays (or sequences) in one call, with the viewport applied to all of them at once.
+# colors is either one (r, g, b) colour for all of them, or an array of n (r, g, b) colours.
+
+# Maps colors to the pixel values of the screen surface, a single value or an array
+def _MapColors(colors):
+    colors = np.asarray(colors)
+    if(colors.ndim == 1):
+        return screen_surface.map_rgb(tuple(int(c) for c in colors[:3]))
+    return pygame.surfarray.map_array(screen_surface, colors[:, :3].astype(np.intp))
+
+def DrawPixels(xs, ys, colors):
+    xs, ys = current_viewport.ToScreen(np.asarray(xs), np.asarray(ys))
+    xs = xs.astype(np.intp)
+    ys = ys.astype(np.intp)
+    mapped = _MapColors(colors)
+
+    # Only the pixels in the clipping rectangle are written, like set_at
+    clip = screen_surface.get_clip()
+    inside = (xs >= clip.left) & (ys >= clip.top) & (xs < clip.right) & (ys < clip.bottom)
+    if(np.ndim(mapped) > 0):
+        mapped = mapped[inside]
+    xs = xs[inside]
+    ys = ys[inside]
+
+    if(screen_surface.get_bytesize() == 3):
+        # 24 bit surfaces can't be referenced as a 2D array
+        pixels = pygame.PixelArray(screen_surface)
+        for x, y, c in zip(xs.tolist(), ys.tolist(), np.broadcast_to(mapped, xs.shape).tolist()):
+            pixels[x, y] = c
+        pixels.close()
+    else:
+        pixels = pygame.surfarray.pixels2d(screen_surface)
+        pixels[xs, ys] = mapped
+        del pixels
+
+# Draws the line segments from (x1s[i], y1s[i]) to (x2s[i], y2s[i])
+def DrawLines(x1s, y1s, x2s, y2s, colors, width=1):
+    x1s, y1s = current_viewport.ToScreen(np.asarray(x1s, dtype=np.float64), np.asarray(y1s, dtype=np.float64))
+    x2s, y2s = current_viewport.ToScreen(np.asarray(x2s, dtype=np.float64), np.asarray(y2s, dtype=np.float64))
+    mapped = np.broadcast_to(_MapColors(colors), x1s.shape)
+
+    # Skip the lines entirely outside of the clipping rectangle
+    clip = screen_surface.get_clip().inflate(2 * width, 2 * width)
+    visible = ~((np.maximum(x1s, x2s) < clip.left) | (np.minimum(x1s, x2s) >= clip.right) | (np.maximum(y1s, y2s) < clip.top) | (np.minimum(y1s, y2s) >= clip.bottom))
+
+    draw_line = pygame.draw.line
+    for x1, y1, x2, y2, c in zip(x1s[visible].tolist(), y1s[visible].tolist(), x2s[visible].tolist(), y2s[visible].tolist(), mapped[visible].tolist()):
+        draw_line(screen_surface, c, (x1, y1), (x2, y2), width)
+
+# Draws the rectangles at (xs[i], ys[i]) of size (ws[i], hs[i])
+def DrawRects(xs, ys, ws, hs, colors, filled=False, linewidth=1):
+    xs, ys = current_viewport.ToScreen(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+    ws = np.broadcast_to(np.asarray(ws, dtype=np.float64), xs.shape)
+    hs = np.broadcast_to(np.asarray(hs, dtype=np.float64), xs.shape)
+    mapped = np.broadcast_to(_MapColors(colors), xs.shape)
+
+    # Skip the rectangles entirely outside of the clipping rectangle
+    clip = screen_surface.get_clip()
+    visible = (xs + ws > clip.left) & (xs < clip.right) & (ys + hs > clip.top) & (ys < clip.bottom)
+
+    rects = zip(xs[visible].tolist(), ys[visible].tolist(), ws[visible].tolist(), hs[visible].tolist(), mapped[visible].tolist())
+    if(filled):
+        fill = screen_surface.fill
+        for x, y, w, h, c in rects:
+            fill(c, pygame.Rect(x, y, w, h))
+    else:
+        draw_rect = pygame.draw.rect
+        for x, y, w, h, c in rects:
+            draw_rect(screen_surface, c, pygame.Rect(x, y, w, h), linewidth)
+
 def DrawLine(x1, y1, x2, y2, r, g, b, width=1):
     x1, y1 = current_viewport.ToScreen(x1, y1)
     x2, y2 = current_viewport.ToScreen(x2, y2)
 
     pygame.draw.line(screen_surface, pygame.Color(int(r),int(g),int(b)), (x1, y1), (x2, y2), width)
 
+# Returns whether the screen rectangle (x, y, w, h) is inside the drawable area
+# Draw calls outside of it are skipped before doing any work
+def _IsOnScreen(x, y, w, h):
+    clip = screen_surface.get_clip()
+    return x < clip.right and y < clip.bottom and x + w > clip.left and y + h > clip.top
+
 def DrawCircle(x, y, radius, r, g, b, filled = False, linewidth = 1):
     x, y = current_viewport.ToScreen(x, y)
+    if(not _IsOnScreen(x - radius, y - radius, 2 * radius + 1, 2 * radius + 1)):
+        return
     if(filled):
         pygame.draw.circle(screen_surface, pygame.Color(int(r), int(g), int(b)), (x,y), radius, 0)
     else:
@@ -539,18 +1257,39 @@ def DrawTriangle(x1, y1, x2, y2, x3, y3, r, g, b, filled = False, linewidth = 1)
     else:
         pygame.draw.polygon(screen_surface, pygame.Color(int(r), int(g), int(b)), [(x1,y1), (x2, y2), (x3, y3)], linewidth)
 
+# Returns the translucent surface of a block, drawing it only if it is not cached
+def _GetBlockSurface(w, h, color, opacity, filled, linewidth):
+    global block_cache_bytes_used
+    key = (w, h, color, opacity, filled, linewidth)
+    rect = block_cache.get(key)
+    if(rect != None):
+        block_cache.move_to_end(key)
+        return rect
+    
+    rect = pygame.surface.Surface((w, h))
+    rect.set_alpha(opacity)
+    if(filled):
+        rect.fill(color)
+    else:
+        pygame.draw.rect(rect, color, [0,0,w,h], linewidth)
+    
+    block_cache[key] = rect
+    block_cache_bytes_used += rect.get_pitch() * rect.get_height()
+
+    # Evict the least recently used blocks
+    while(len(block_cache) > 1 and (len(block_cache) > block_cache_size or block_cache_bytes_used > block_cache_bytes)):
+        _, evicted = block_cache.popitem(last=False)
+        block_cache_bytes_used -= evicted.get_pitch() * evicted.get_height()
+    
+    return rect
+
 def DrawBlock(x, y, w, h, r, g, b, filled = False, linewidth = 1, opacity=255):
     x, y = current_viewport.ToScreen(x, y)
+    if(not _IsOnScreen(x, y, w, h)):
+        return
     
     if(opacity != 255):
-        rect = pygame.surface.Surface((w, h))
-        rect.set_alpha(opacity)
-        if(filled):
-            rect.fill((int(r), int(g), int(b)))
-        else:
-            pygame.draw.rect(rect, (int(r), int(g), int(b)), [0,0,w,h], linewidth)
-        
-        screen_surface.blit(rect, [x, y])
+        screen_surface.blit(_GetBlockSurface(w, h, (int(r), int(g), int(b)), opacity, filled, linewidth), [x, y])
         return
     
     if(filled):
@@ -558,55 +1297,109 @@ def DrawBlock(x, y, w, h, r, g, b, filled = False, linewidth = 1, opacity=255):
     else:
         pygame.draw.rect(screen_surface, pygame.Color(int(r), int(g), int(b)), pygame.Rect(x, y, w, h), linewidth)
 
-def DrawImage(img, x, y, pivotx=0, pivoty=0, angle=0, horiz_flip = False, vert_flip = False, opacity=255):
+# Rounds an angle to a multiple of rotation_step, in [0, 360)
+def _QuantizeAngle(angle):
+    if(rotation_step > 0):
+        angle = round(angle / rotation_step) * rotation_step
+    return angle % 360
+
+# Flips, makes translucent and rotates (in this order) a surface into a new one
+# smooth - rotate with rotozoom, which filters the image instead of picking pixels
+def _Transform(surface, horiz_flip, vert_flip, opacity, angle, smooth):
+    if(horiz_flip or vert_flip):
+        surface = pygame.transform.flip(surface.convert_alpha(), horiz_flip, vert_flip)
+    if(opacity != 255):
+        surface = surface.convert_alpha()
+        surface.fill((255, 255, 255, opacity), special_flags=pygame.BLEND_RGBA_MULT)
+    if(angle != 0):
+        if(smooth):
+            surface = pygame.transform.rotozoom(surface, angle, 1)
+        else:
+            surface = pygame.transform.rotate(surface, angle)
+    return surface
+
+# Returns the surface of img flipped, made translucent and rotated (in this order).
+# The transformed surfaces are kept in transform_cache (or were precomputed in
+# img.rotations), so drawing the same image with the same transform again costs no allocation.
+# Note: the cache doesn't see changes made to the pixels of img, call ClearTransformCache()
+def TransformImage(img, horiz_flip=False, vert_flip=False, opacity=255, angle=0, smooth=False):
+    global transform_cache_bytes_used, transform_cache_hits, transform_cache_misses
+    if(not horiz_flip and not vert_flip and opacity == 255 and angle == 0):
+        return img.image_data
+    
+    if(img.rotations != None):
+        surface = img.rotations.get((horiz_flip, vert_flip, opacity, angle, smooth))
+        if(surface != None):
+            return surface
+    
+    key = (img.image_data, horiz_flip, vert_flip, opacity, angle, smooth)
+    surface = transform_cache.get(key)
+    if(surface != None):
+        transform_cache_hits += 1
+        transform_cache.move_to_end(key)
+        return surface
+    
+    transform_cache_misses += 1
+    surface = _Transform(img.image_data, horiz_flip, vert_flip, opacity, angle, smooth)
+    transform_cache[key] = surface
+    transform_cache_bytes_used += surface.get_pitch() * surface.get_height()
+
+    # Evict the least recently used surfaces
+    while(len(transform_cache) > 1 and (len(transform_cache) > transform_cache_size or transform_cache_bytes_used > transform_cache_bytes)):
+        _, evicted = transform_cache.popitem(last=False)
+        transform_cache_bytes_used -= evicted.get_pitch() * evicted.get_height()
+    
+    return surface
+
+def ClearTransformCache():
+    global transform_cache_bytes_used
+    transform_cache.clear()
+    transform_cache_bytes_used = 0
+
+# Draws an image with its pivot point at (x, y), rotated counterclockwise about
+# the pivot by angle degrees (rounded to rotation_step, see TransformImage)
+# smooth - filter the rotated image, slower to compute but without jagged edges
+def DrawImage(img, x, y, pivotx=0, pivoty=0, angle=0, horiz_flip = False, vert_flip = False, opacity=255, smooth=False):
     # Transform to viewport
     x, y = current_viewport.ToScreen(x, y)
-    if(horiz_flip):
-        img = FlipImage(img, True, False)
-    if(vert_flip):
-        img = FlipImage(img, False, True)
-
-    if(opacity != 255):
-        img = OpacityImage(img, opacity)
-        
+    if(angle != 0):
+        angle = _QuantizeAngle(angle)
+    
+    # Skip images out of view before transforming them. Rotated images stay
+    # within the circle around the pivot through the farthest corner.
+    w, h = img.image_data.get_size()
     if(angle == 0):
-            screen_surface.blit(img.image_data, (round(x - pivotx), round(y - pivoty)))
+        if(not _IsOnScreen(x - pivotx, y - pivoty, w, h)):
+            return
     else:
-        w = img.w
-        h = img.h
-
-        # This is the rectangle of the original image.
-        box = [pygame.math.Vector2(p) for p in [(0,0), (w,0), (w,-h), (0, -h)]]
-
-        # This is the rotated rectangle itself
-        box_rotate = [p.rotate(angle) for p in box]
+        radius = math.hypot(max(pivotx, w - pivotx), max(pivoty, h - pivoty)) + 1
+        if(not _IsOnScreen(x - radius, y - radius, 2 * radius, 2 * radius)):
+            return
         
-        # The minimum (top left) and maximum co-ordinates (bottom right) of the box
-        min_box = (min(box_rotate, key=lambda p: p[0])[0], min(box_rotate, key=lambda p: p[1])[1])
-        max_box = (max(box_rotate, key=lambda p: p[0])[0], max(box_rotate, key=lambda p: p[1])[1])
-
-        # The pivot vector
-        pivot = pygame.math.Vector2(pivotx, -pivoty)
-
-        # Rotating the pivot vector
-        pivot_rotated = pivot.rotate(angle)
+    if(angle == 0):
+            screen_surface.blit(TransformImage(img, horiz_flip, vert_flip, opacity), (round(x - pivotx), round(y - pivoty)))
+    else:
+        rotated_image = TransformImage(img, horiz_flip, vert_flip, opacity, angle, smooth)
 
-        # Difference b/w the rotated and the current pivot
-        pivot_ds = pivot_rotated - pivot
+        # The image is rotated about its centre, so the vector from the centre to the pivot
+        # turns with it. Note: the screen y-axis points down, so counterclockwise is -angle
+        pivot = pygame.math.Vector2(pivotx - w / 2, pivoty - h / 2).rotate(-angle)
 
-        # Rotating the image causes change in the center of the image so the new origin 
-        # has to be changed.
+        # The rotated image is centred on its old centre, which moved around the pivot
         origin = [
-            (x - pivotx + min_box[0] - pivot_ds[0]), 
-            (y - pivoty - max_box[1] + pivot_ds[1])
+            (x - pivot[0] - rotated_image.get_width() / 2),
+            (y - pivot[1] - rotated_image.get_height() / 2)
         ]
-        rotated_image = pygame.transform.rotate(img.image_data, angle)
+        screen_surface.blit(rotated_image, (round(origin[0]), round(origin[1])))
 
-def DrawSprite(spr, index, x, y, pivotx=0, pivoty=0, angle=0, horiz_flip=False, vert_flip=False):
+def DrawSprite(spr, index, x, y, pivotx=0, pivoty=0, angle=0, horiz_flip=False, vert_flip=False, smooth=False):
         if(index < spr.total_frames):
-            DrawImage(spr.sprite_frames[int(index)], x, y, pivotx, pivoty, angle, horiz_flip, vert_flip)
+            DrawImage(spr.sprite_frames[int(index)], x, y, pivotx, pivoty, angle, horiz_flip, vert_flip, smooth=smooth)
 
-def LoadImage(file):
+# atlas - TextureAtlas to pack the image into, the returned image is then an AtlasRegion
+def LoadImage(file, atlas=None):
+    if(atlas != None):
+        return atlas.Add(Image(file))
     return Image(file)
 
 def DuplicateImage(img):
@@ -675,22 +1468,38 @@ def Quit():
     pygame.quit()
 
 def AddObject(obj):
-    global object_counter
+    global object_counter, object_array_stale
     object_counter += 1
     
     obj.id = object_counter
-    object_array.append(obj)
+    object_registry[obj.id] = obj
+    object_array_stale = True
+    if(not obj.disabled):
+        _SubscribeEvents(obj)
     
     obj.Create()
+    _IndexObject(obj, obj.GetBounds())
 
     return obj.id
 
 def DeleteObject(id):
-    destruction_queue.append(id)
+    destruction_queue.add(id)
+
+# Returns the active object with the given id, or None
+def GetObject(id):
+    return object_registry.get(id)
+
+# Returns all the active objects in creation order
+def GetObjects():
+    global object_array, object_array_stale
+    if(object_array_stale):
+        object_array = tuple(object_registry.values())
+        object_array_stale = False
+    return object_array
 
 def EnableAllObjects():
-    for i in range(len(object_array)):
-        object_array[i].Enable()
+    for object in GetObjects():
+        object.Enable()
         
 
 def Init(w, h, window_w=0, window_h=0, borderless=False, custom_title_bar=False):
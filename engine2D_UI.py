@@ -1,5 +1,10 @@
 import engine2D
 import os
+import bisect
+import threading
+import queue
+
+from collections import deque, OrderedDict
 
 # PictureBox
 # Displays a picture 
@@ -12,6 +17,10 @@ class PictureBox(engine2D.Object):
         self.image = engine2D.Image(filename, w, h)
         self.x = x
         self.y = y
+        self.MarkDirty()
+
+    def GetBounds(self):
+        return (self.x, self.y, self.image.w, self.image.h)
 
     def Draw(self, elapsed):
         engine2D.DrawImage(self.image, self.x, self.y)
@@ -27,7 +36,12 @@ class Label(engine2D.Object):
         self.font = font
     
     def SetCaption(self, caption):
-        self.caption = caption
+        if(caption != self.caption):
+            self.caption = caption
+            self.MarkDirty()
+
+    def GetBounds(self):
+        return (self.x, self.y, self.font.ch_w * len(self.caption), self.font.ch_h)
     
     def Draw(self, elapsed):
         self.font.PutString(self.caption, self.x, self.y)
@@ -47,7 +61,9 @@ class ProgressBar(engine2D.Object):
     def SetProgress(self, p):
         if(p > 100):
             p = 100
-        self.progress = p
+        if(p != self.progress):
+            self.progress = p
+            self.MarkDirty()
     
     def Draw(self, elapsed):
         engine2D.DrawBlock(self.x, self.y, self.w, self.h, 255, 255, 255, True)
@@ -131,6 +147,7 @@ class DialogBoxOKCancel(DialogBoxOK):
     def OnKeyPress(self, elapsed, key):
         if(key == engine2D.Button.LEFT or key == engine2D.Button.RIGHT):
             self.selected = not self.selected
+            self.MarkDirty()
         elif(key == engine2D.Button.RETURN):
             if(self.callback):
                 self.callback(self.id, self.selected)
@@ -156,9 +173,40 @@ class DialogBoxOKCancel(DialogBoxOK):
 class _ListBox_Choice:
     def __init__(self, choice_str, max_chars_per_line, id):
         self.choice_lines = [ choice_str[x - max_chars_per_line: x] for x in range(max_chars_per_line, len(choice_str)+max_chars_per_line, max_chars_per_line)]
+        # Empty choices still take up a line
+        if(self.choice_lines == []):
+            self.choice_lines = ['']
         self.n_lines = len(self.choice_lines)
         self.id = id
 
+# Internal function
+# Builds the type-ahead index of a list of choices: the choice indices sorted by
+# their lowercase text, and the sorted lowercase texts. Safe to call from a worker thread.
+def _SortChoices(choices):
+    lowered = [c.lower() for c in choices]
+    order = sorted(range(len(lowered)), key=lowered.__getitem__)
+    return order, [lowered[i] for i in order]
+
+# Inernal class
+# A range of the type-ahead index, i.e. the choices starting with the filter string
+# Behaves as a read-only list of the matching choices, in alphabetical order
+class _ListBox_Filter:
+    def __init__(self, choices, order, lo, hi):
+        self.choices = choices
+        self.order = order
+        self.lo = lo
+        self.hi = hi
+    
+    def __len__(self):
+        return self.hi - self.lo
+    
+    def __getitem__(self, idx):
+        return self.choices[self.order[self.lo + idx]]
+
+    # Returns the index in the original choices of a filtered choice
+    def Index(self, idx):
+        return self.order[self.lo + idx]
+
 # Listbox - display a list to the user
 # choices - Array of strings with the choices to be listed on the listbox
 # input_callback - A function that takes two integers as input
@@ -173,13 +221,21 @@ class _ListBox_Choice:
 # the user selects a choice.
 # CHOICE_SELECT is also called at start, representing choice 0.
 # choice_index is the index of the choice chosen by user in the array passed
+# type_ahead - if True, typing filters the list to the choices starting with the typed
+# text (case insensitive), backspace widens it again. choice_index is still the index
+# in the array passed.
+
+# The listbox is virtualized: choices are only split into lines when they are
+# visible, so it works with very large lists. The view scrolls line by line,
+# and starts at line top_line of choice top_choice.
 
 class ListBox(engine2D.Object):
     CHOICE_SELECT = 0
     CHOICE_CHOSEN = 1
 
-    def __init__(self, choices, input_callback, x, y, w, h, font, back_color=(0,0,0), select_color=(40, 110, 40), choice_change_callback=0):
+    def __init__(self, choices, input_callback, x, y, w, h, font, back_color=(0,0,0), select_color=(40, 110, 40), choice_change_callback=0, type_ahead=False):
         super().__init__()
+        self.type_ahead = type_ahead
         self.callback = input_callback
         self.font = font
         self.x = x
@@ -190,64 +246,166 @@ class ListBox(engine2D.Object):
         self.back_color = back_color
         self.select_color = select_color
 
-        self.max_lines = int(self.h / self.font.ch_h)
-        self.max_chars_per_line = int(self.w / self.font.ch_w)
+        self.max_lines = max(int(self.h / self.font.ch_h), 1)
+        self.max_chars_per_line = max(int(self.w / self.font.ch_w), 1)
 
         self.BuildChoiceBlocks(choices)
     
-    def BuildChoiceBlocks(self, choices):
-        self.choices = []
-        for idx, choice_str in enumerate(choices):
-            self.choices.append(_ListBox_Choice(choice_str, self.max_chars_per_line, idx))
+    # filter_index is an already built type-ahead index of the choices, if any
+    def BuildChoiceBlocks(self, choices, filter_index=None):
+        # Choices are laid out lazily by _GetChoice(), only the visible ones are kept
+        # self.choices is what is shown, all the choices or the type-ahead matches
+        self.all_choices = choices
+        self.choices = choices
+        self.choice_cache = {}
+
+        # Type-ahead index, the choice indices sorted by their lowercase text
+        self.filter_string = ""
+        self.filter_order = None
+        self.filter_keys = None
+        if(filter_index != None):
+            self.filter_order, self.filter_keys = filter_index
+        elif(self.type_ahead):
+            self._BuildFilterIndex()
+
+        self.current_choice = 0
+        self.top_choice = 0
+        self.top_line = 0
+        self.MarkDirty()
+
+    # Returns the layout of a choice, splitting it into lines if needed
+    def _GetChoice(self, idx):
+        choice = self.choice_cache.get(idx)
+        if(choice == None):
+            choice = _ListBox_Choice(self.choices[idx], self.max_chars_per_line, idx)
+            self.choice_cache[idx] = choice
+        return choice
+
+    # Scrolls the view the least amount needed to show the whole current choice
+    # Only the choices between the view and the current choice are laid out.
+    def _EnsureVisible(self):
+        current = self.current_choice
+        # Above the view, it becomes the top of the view
+        if(current < self.top_choice or (current == self.top_choice and self.top_line > 0)):
+            self.top_choice = current
+            self.top_line = 0
+            return
+        
+        # Count the lines from the top of the view to the end of the current choice
+        # (every choice takes at least one line, so it can't fit if it is too far)
+        if(current - self.top_choice < self.max_lines):
+            n_lines = -self.top_line
+            for k in range(self.top_choice, current + 1):
+                n_lines += self._GetChoice(k).n_lines
+            if(n_lines <= self.max_lines):
+                return
+        
+        # Below the view, scroll until the current choice is at the bottom of the view
+        n_lines = self._GetChoice(current).n_lines
+        if(n_lines >= self.max_lines):
+            # Taller than the listbox, show as much as we can from its start
+            self.top_choice = current
+            self.top_line = 0
+            return
         
-        # Create choice "blocks" - blocks of choices which can be displayed at once on the screen
-        # This is because our 'choices' may be too long to put in one go.
-        # So we calculate how much line each choice takes,
-        # And then group choices into groups that hold maximum lines that can be displayed on the screen
-        # So if the user scrolls down past the last choice on screen, we simply switch to the next choice block
-        i = 0
-        n_lines = 0
-        self.choice_blocks = [[]]
-
-        # Here we create a dictionary to allow for quick access to choice blocks
-        # directly through the choice indices
-
-        # For example if index 4 belongs to choice block 1, then self.choice_blocks_dict["4"] = 1
-        self.choice_blocks_dict = {}
+        top = current
+        while(top > 0 and n_lines + self._GetChoice(top - 1).n_lines <= self.max_lines):
+            top -= 1
+            n_lines += self._GetChoice(top).n_lines
         
-        for choice in self.choices:
-            n_lines += choice.n_lines
-            # Check if we exceeded the capacity of the maxlines on screen
-            if(n_lines >= self.max_lines):
-                # Don't forget that we're still adding the current file, even if we ran out of
-                # space! 
-                n_lines = choice.n_lines
-                # If we ran out of space, we won't print this file on this choice block
-                # and move on to the next
-                self.choice_blocks.append([])
-                # BUG: There is a possibility that the file name won't fit on the entire choice block at all,
-                # the program would simply be stuck in an infinite loop and would keep incrementing i. 
-                i += 1
+        self.top_line = 0
+        # Partially show the choice above to fill up the view
+        if(top > 0 and n_lines < self.max_lines):
+            top -= 1
+            self.top_line = self._GetChoice(top).n_lines - (self.max_lines - n_lines)
+        self.top_choice = top
+
+    def SetChoice(self, idx):
+        if(idx >= len(self.choices)): idx = len(self.choices) - 1
+        if(idx < 0): idx = 0
+        if(idx != self.current_choice):
+            self.current_choice = idx
+            self._EnsureVisible()
+            self.MarkDirty()
+
+    # Returns the index in the original choices of the current choice, or None if
+    # there is nothing to choose from (e.g. nothing matches the type-ahead filter)
+    def GetChoiceIndex(self):
+        if(len(self.choices) == 0):
+            return None
+        return self.GetOriginalIndex(self.current_choice)
+
+    # Returns the index in the original choices of the shown choice k
+    def GetOriginalIndex(self, k):
+        if(self.choices is self.all_choices):
+            return k
+        return self.choices.Index(k)
+
+    def _BuildFilterIndex(self):
+        self.filter_order, self.filter_keys = _SortChoices(self.all_choices)
+
+    # Shows only the choices starting with the given string
+    # Narrowing an existing filter only searches within its range
+    def SetFilter(self, filter_string):
+        if(filter_string == ""):
+            self.choices = self.all_choices
+        else:
+            if(self.filter_order == None):
+                self._BuildFilterIndex()
+            
+            query = filter_string.lower()
+            lo = 0
+            hi = len(self.filter_keys)
+            if(self.choices is not self.all_choices and query.startswith(self.filter_string.lower())):
+                lo = self.choices.lo
+                hi = self.choices.hi
             
-            self.choice_blocks[i].append(choice.id)
-            self.choice_blocks_dict[choice.id] = i
+            lo = bisect.bisect_left(self.filter_keys, query, lo, hi)
+            hi = bisect.bisect_left(self.filter_keys, query + chr(0x10FFFF), lo, hi)
+            self.choices = _ListBox_Filter(self.all_choices, self.filter_order, lo, hi)
         
+        self.filter_string = filter_string
+        self.choice_cache = {}
         self.current_choice = 0
+        self.top_choice = 0
+        self.top_line = 0
+        self.MarkDirty()
+        self.ProcessChoice(self.CHOICE_SELECT)
+
+    def OnTextInput(self, elapsed, c):
+        if(not self.type_ahead):
+            return
+        if(c == '\b'):
+            if(self.filter_string != ""):
+                self.SetFilter(self.filter_string[:-1])
+        elif(c.isprintable()):
+            self.SetFilter(self.filter_string + c)
+
+    # Returns the first line of the shown choice k as it should be drawn
+    # Subclasses override this to decorate choices
+    def FormatChoice(self, k, line):
+        return line
+
+    def GetBounds(self):
+        # Includes the selection arrow on the left and the scroll signs above and below
+        return (self.x - self.font.ch_w, self.y - self.font.ch_h, self.w + self.font.ch_w + 1, self.h + 2 * self.font.ch_h)
     
     def ProcessChoice(self, input_type):
         # Give the callback the choice taken
-        if(self.callback):
-            self.callback(self.id, input_type, self.current_choice)
+        if(self.callback and self.GetChoiceIndex() != None):
+            self.callback(self.id, input_type, self.GetChoiceIndex())
             if(input_type == self.CHOICE_CHOSEN):
                 self.Delete()
         
     def OnKeyPress(self, elapsed, key):
         if(key == engine2D.Button.UP):
-            self.current_choice -= 1
-            if(self.current_choice < 0): self.current_choice = 0
+            self.SetChoice(self.current_choice - 1)
         if(key == engine2D.Button.DOWN):
-            self.current_choice += 1
-            if(self.current_choice >= len(self.choices)): self.current_choice = len(self.choices) - 1
+            self.SetChoice(self.current_choice + 1)
+        if(key == engine2D.Button.PG_UP):
+            self.SetChoice(self.current_choice - self.max_lines)
+        if(key == engine2D.Button.PG_DOWN):
+            self.SetChoice(self.current_choice + self.max_lines)
         if(key == engine2D.Button.RETURN):
             self.ProcessChoice(self.CHOICE_CHOSEN)
         if(key == engine2D.Button.UP or engine2D.Button.DOWN):
@@ -260,41 +418,56 @@ class ListBox(engine2D.Object):
 
         # Current_Line variable to keep track of where we are at relative to (self.x, self.y)
         current_line = 0
-
-        # Figure out where we are, i.e. which choice block to print
-        choice_block_idx =  self.choice_blocks_dict[self.current_choice]
-        current_choice_block = self.choice_blocks[choice_block_idx]
-
-        # If there is a choice block above, print a scroll up sign, that is we are at a choice
-        # block that is not the first block.
-        if(choice_block_idx > 0):
-            self.font.PutString("^", self.x + self.w * 0.5 - self.font.ch_w, self.y - self.font.ch_h)
-        # If there are choice blocks belows, print a scroll down sign
-        if(choice_block_idx < len(self.choice_blocks) - 1):
-            self.font.PutString("v", self.x + self.w * 0.5 - self.font.ch_w, self.y + self.h)
-        
-        for k in current_choice_block:
-            choice = self.choices[k]
-            # If we ran out of lines to print, leave
-            if(current_line >= self.max_lines):
-                break
+        # The lines of text are drawn in one batch at the end
+        text_lines = []
+
+        # Walk the choices from the top of the view until the listbox is full
+        # Only the choices drawn are kept laid out for the next frame
+        visible_choices = {}
+        k = self.top_choice
+        line_start = self.top_line
+        while(current_line < self.max_lines and k < len(self.choices)):
+            choice = self._GetChoice(k)
+            visible_choices[k] = choice
             # Split the lines to contain the maximum of self.max_chars_per_line
             # Now iterate through the split lines and print them one by one
-            for idx, line in enumerate(choice.choice_lines):
-                # Are we a file list box? If so check if the current choice is a directory and add a '->' as well
-                # to tell the user that it is indeed a directory
-                if(idx == 0 and type(self) == FileListBox):
-                    if(os.path.isdir(self.current_directory + ''.join(choice.choice_lines))):
-                        line = "-> " + line
+            for idx in range(line_start, choice.n_lines):
+                # If we ran out of lines to print, leave
+                if(current_line >= self.max_lines):
+                    break
+                line = choice.choice_lines[idx]
+                if(idx == 0):
+                    line = self.FormatChoice(k, line)
 
                 # If we are drawing the current choice, make sure to draw a redbox around it (to denote selection)
                 if(choice.id == self.current_choice):
                     # if its the first line of the selected choice, print an arrow as well
                     if(idx == 0): 
-                        self.font.PutString(">", self.x - self.font.ch_w, self.y + (current_line) * self.font.ch_h)
+                        text_lines.append((">", self.x - self.font.ch_w, self.y + (current_line) * self.font.ch_h))
                     engine2D.DrawBlock(self.x + 1, self.y + (current_line) * self.font.ch_h, self.w - 1, self.font.ch_h, self.select_color[0], self.select_color[1], self.select_color[2], True)
-                self.font.PutString(line, self.x, self.y + (current_line) * self.font.ch_h)
+                text_lines.append((line, self.x, self.y + (current_line) * self.font.ch_h))
                 current_line += 1
+                line_start = idx + 1
+            
+            if(line_start >= choice.n_lines):
+                k += 1
+                line_start = 0
+        
+        self.choice_cache = visible_choices
+
+        # If there is more above, print a scroll up sign
+        if(self.top_choice > 0 or self.top_line > 0):
+            text_lines.append(("^", self.x + self.w * 0.5 - self.font.ch_w, self.y - self.font.ch_h))
+        # If there is more below, print a scroll down sign
+        if(k < len(self.choices)):
+            text_lines.append(("v", self.x + self.w * 0.5 - self.font.ch_w, self.y + self.h))
+        # Show the end of the type-ahead filter below the list, left of the scroll down sign
+        label_chars = int((self.w * 0.5 - self.font.ch_w) / self.font.ch_w)
+        if(self.filter_string != "" and label_chars > 0):
+            tail_start = max(len(self.filter_string) - (label_chars - 1), 0)
+            text_lines.append(("/" + self.filter_string[tail_start:], self.x, self.y + self.h))
+        
+        self.font.PutStrings(text_lines)
 
 # FileListBox
 # root - highest directory in the hierarchy
@@ -304,9 +477,16 @@ class ListBox(engine2D.Object):
 # font - font to be used for the file-lising
 # back_color - back_color of the file list box
 # select_color - select color of the file list box
+# type_ahead - filter the files by typing their name, see ListBox
+# background_loading - list directories in a worker thread, the files are added to the
+# list as they are found. Navigating away cancels the listing.
 class FileListBox(ListBox):
+    # Number of directory listings kept
+    DIRECTORY_CACHE_SIZE = 16
+    # Number of files sent at once by the background listing
+    LOAD_CHUNK_SIZE = 512
 
-    def __init__(self, root, input_callback, x, y, w, h, font, back_color=(0,0,0), select_color=(40, 110, 52)):
+    def __init__(self, root, input_callback, x, y, w, h, font, back_color=(0,0,0), select_color=(40, 110, 52), type_ahead=False, background_loading=False):
 
         # First get a list of files from the root directory
         if(not root[-1] == '\\'):
@@ -314,15 +494,186 @@ class FileListBox(ListBox):
         
         self.root = root
         self.current_directory = root
+
+        # Directory listings, indexed by path: (mtime, file names, set of directory names, type-ahead index)
+        # The type-ahead index is only built by the background listing, otherwise it is None
+        self.directory_cache = OrderedDict()
+
+        # Background listing state. Every listing is a job, messages from the worker
+        # threads are tagged with their job so the ones of cancelled jobs are ignored.
+        self.background_loading = background_loading
+        self.loading = False
+        self.load_error = None
+        self.load_job = 0
+        self.load_cancelled = None
+        self.load_results = queue.Queue()
+            
+        self.current_file_list = []
+        self.current_directories = set()
+        super().__init__(self.current_file_list, input_callback, x, y, w, h, font, back_color, select_color, type_ahead=type_ahead)
+        self.Refresh()
+
+    # Lists a directory with os.scandir, returning the file names and the set of
+    # the names that are directories. Listings are reused while the mtime of the
+    # directory is unchanged.
+    def _ListDirectory(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.directory_cache.get(path)
+        if(cached != None and cached[0] == mtime):
+            self.directory_cache.move_to_end(path)
+            return cached[1], cached[2]
+        
+        names = []
+        directories = set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                names.append(entry.name)
+                if(entry.is_dir()):
+                    directories.add(entry.name)
+        
+        self.directory_cache[path] = (mtime, names, directories, None)
+        if(len(self.directory_cache) > self.DIRECTORY_CACHE_SIZE):
+            self.directory_cache.popitem(last=False)
+        return names, directories
+
+    # Lists the current directory (from the cache if it hasn't changed) and rebuilds the list
+    def Refresh(self):
+        self._CancelLoading()
+        if(self.current_directory != self.root):
+            self.current_file_list = [".."]
+        else:
+            self.current_file_list = []
+        
+        filter_index = None
+        if(self.background_loading):
+            self.current_directories = set()
+            filter_index = self._StartLoading()
+        else:
+            names, self.current_directories = self._ListDirectory(self.current_directory)
+            self.current_file_list += names
+        
+        self.BuildChoiceBlocks(self.current_file_list, filter_index)
+
+    # Runs in a worker thread, lists the directory in chunks into load_results
+    # Only touches load_results, the directory cache belongs to the main thread
+    # file_list is the start of the list (i.e. ".."), the type-ahead index sent
+    # with the "done" message covers it and all the files found
+    def _LoadDirectoryWorker(self, path, mtime, job, cancelled, file_list, type_ahead):
+        try:
+            file_list = list(file_list)
+            chunk = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if(cancelled.is_set()):
+                        return
+                    chunk.append((entry.name, entry.is_dir()))
+                    file_list.append(entry.name)
+                    if(len(chunk) >= self.LOAD_CHUNK_SIZE):
+                        self.load_results.put((job, "entries", chunk))
+                        chunk = []
+            
+            self.load_results.put((job, "entries", chunk))
+            filter_index = _SortChoices(file_list) if type_ahead else None
+            if(cancelled.is_set()):
+                return
+            self.load_results.put((job, "done", (mtime, filter_index)))
+        except OSError as e:
+            self.load_results.put((job, "error", e))
+
+    # Starts listing the current directory in the background, unless its listing is cached
+    # Returns the cached type-ahead index of the listing, if any
+    def _StartLoading(self):
+        self.load_job += 1
+        self.load_error = None
+        try:
+            mtime = os.stat(self.current_directory).st_mtime_ns
+        except OSError as e:
+            self.load_error = e
+            return
+        
+        cached = self.directory_cache.get(self.current_directory)
+        if(cached != None and cached[0] == mtime):
+            self.directory_cache.move_to_end(self.current_directory)
+            self.current_file_list += cached[1]
+            self.current_directories = cached[2]
+            return cached[3]
+        
+        self.load_cancelled = threading.Event()
+        self.loading = True
+        threading.Thread(target=self._LoadDirectoryWorker, args=(self.current_directory, mtime, self.load_job, self.load_cancelled, self.current_file_list, self.type_ahead), daemon=True).start()
+        return None
+
+    def _CancelLoading(self):
+        if(self.loading):
+            self.load_cancelled.set()
+            self.loading = False
+
+    # filter_index is the type-ahead index built by the worker, None if the listing failed
+    def _FinishLoading(self, filter_index):
+        self.loading = False
+        self.MarkDirty()
+        # The type-ahead index has to include all the files
+        if(self.type_ahead):
+            if(filter_index != None):
+                self.filter_order, self.filter_keys = filter_index
+            else:
+                self._BuildFilterIndex()
+            if(self.filter_string != ""):
+                # The filter was applied to the files found so far, search it again from scratch
+                self.choices = self.all_choices
+                self.SetFilter(self.filter_string)
+
+    def Update(self, elapsed):
+        # Add the files found by the background listing to the list
+        while(self.loading):
+            try:
+                job, kind, data = self.load_results.get_nowait()
+            except queue.Empty:
+                break
             
-        self.current_file_list = os.listdir(self.current_directory)
-        super().__init__(self.current_file_list, input_callback, x, y, w, h, font, back_color, select_color)
+            if(job != self.load_job):
+                continue
+            
+            if(kind == "entries"):
+                for name, is_dir in data:
+                    self.current_file_list.append(name)
+                    if(is_dir):
+                        self.current_directories.add(name)
+                self.MarkDirty()
+            elif(kind == "done"):
+                mtime, filter_index = data
+                names = self.current_file_list[1:] if self.current_directory != self.root else list(self.current_file_list)
+                self.directory_cache[self.current_directory] = (mtime, names, self.current_directories, filter_index)
+                if(len(self.directory_cache) > self.DIRECTORY_CACHE_SIZE):
+                    self.directory_cache.popitem(last=False)
+                self._FinishLoading(filter_index)
+            elif(kind == "error"):
+                self.load_error = data
+                self._FinishLoading(None)
+
+    def NextUpdate(self):
+        return 0 if self.loading else None
+
+    def Delete(self):
+        self._CancelLoading()
+        super().Delete()
+
+    def IsDirectory(self, file_name):
+        return file_name == ".." or file_name in self.current_directories
+
+    def FormatChoice(self, k, line):
+        # Add a '->' to the directories to tell the user that it is indeed a directory
+        if(self.IsDirectory(self.current_file_list[self.GetOriginalIndex(k)])):
+            return "-> " + line
+        return line
     
     def ProcessChoice(self, input_type):
-        file_choice = self.current_file_list[self.current_choice]
+        if(self.GetChoiceIndex() == None):
+            return
+        file_choice = self.current_file_list[self.GetChoiceIndex()]
 
         # Check if choice is a file or a folder
-        if((os.path.isdir(self.current_directory + file_choice) or file_choice == "..") and input_type == self.CHOICE_CHOSEN):
+        if(self.IsDirectory(file_choice) and input_type == self.CHOICE_CHOSEN):
             if(file_choice == ".."):
                 # This is the previous directory
                 # Back track until we find the previous backslash
@@ -330,39 +681,53 @@ class FileListBox(ListBox):
                     if(self.current_directory[len(self.current_directory) - i] == '\\'):
                         self.current_directory = self.current_directory[0:len(self.current_directory)-i+1]
                         break
-                
-                # Now list the directory
-                self.current_file_list = os.listdir(self.current_directory)
-                if(self.current_directory != self.root):
-                    self.current_file_list = [".."] + self.current_file_list
-                
-                # Rebuild the choiceblocks
-                self.BuildChoiceBlocks(self.current_file_list)
             else:
                 # Ok! Its a directory. 
                 # Add to it
                 self.current_directory += file_choice + "\\"
-                self.current_file_list = [".."] + os.listdir(self.current_directory)
-                self.BuildChoiceBlocks(self.current_file_list)
+            
+            # Now list the directory and rebuild the list
+            self.Refresh()
 
         else:
             if(self.callback):
-                self.callback(self.id, input_type, self.current_directory + self.current_file_list[self.current_choice])
+                self.callback(self.id, input_type, self.current_directory + file_choice)
             if(input_type == self.CHOICE_CHOSEN):
                 self.Delete()
         
+    # Returns the name of the selected file, or an empty string if there is none
+    def GetSelectedFile(self):
+        if(self.GetChoiceIndex() == None):
+            return ""
+        return self.current_file_list[self.GetChoiceIndex()]
+
+    # Returns the text of the upper ribbon bar
+    def GetRibbonText(self):
+        if(self.loading):
+            return "Loading... (" + str(len(self.current_file_list)) + " files)"
+        if(self.load_error != None):
+            return "Error: " + str(self.load_error)
+        
+        current_file = "Selected: " + self.GetSelectedFile()
+        if(self.IsDirectory(self.GetSelectedFile())):
+            current_file += " (DIRECTORY)"
+        return current_file
+
     def Draw(self, elapsed):
         # Draw the upper ribbon bar
         engine2D.DrawBlock(self.x, self.y - self.font.ch_h * 2, self.w, self.font.ch_h * 2, 30, 30, 110, True)
         engine2D.DrawBlock(self.x - 1, self.y - self.font.ch_h * 2, self.w + 1, self.font.ch_h * 2, 255, 255, 255)
-        current_file = "Selected: " + self.current_file_list[self.current_choice]
-        if(os.path.isdir(self.current_directory + current_file)):
-            current_file += " (DIRECTORY)"
-        self.font.PutString(current_file, self.x, self.y - self.font.ch_h * 2)
+        self.font.PutString(self.GetRibbonText(), self.x, self.y - self.font.ch_h * 2)
 
         # Draw the rest of the list
         super().Draw(elapsed)
 
+    def GetBounds(self):
+        # The ribbon bar sits two lines above the list, and the selected file name may overflow it
+        x, y, w, h = super().GetBounds()
+        ribbon_w = self.font.ch_w * len(self.GetRibbonText())
+        return (x, self.y - self.font.ch_h * 2, max(w, ribbon_w + self.font.ch_w), h + self.font.ch_h)
+
 # Textbox control
 # Creates a textbox control
 # x,y,width,font
@@ -388,6 +753,7 @@ class TextBox(engine2D.Object):
     
     def OnTextInput(self, elapsed, c):
         self.cursor_on = True
+        self.MarkDirty()
         if(c.isprintable()):
             self.text = self.text[0:self.insertion_index] + c + self.text[self.insertion_index:]
             self.insertion_index += 1
@@ -398,11 +764,15 @@ class TextBox(engine2D.Object):
         self.ValidateIndexes()
 
     def OnKeyPress(self, elapsed, key):
-        self.cursor_on = True
         if(key == engine2D.Button.LEFT):
             self.insertion_index -= 1
         elif(key == engine2D.Button.RIGHT):
             self.insertion_index += 1
+        else:
+            return
+        
+        self.cursor_on = True
+        self.MarkDirty()
         
         self.ValidateIndexes()
 
@@ -426,6 +796,14 @@ class TextBox(engine2D.Object):
         if(self.cursor_timer >= 0.5):
             self.cursor_on = not self.cursor_on
             self.cursor_timer = 0
+            self.MarkDirty()
+
+    def NextUpdate(self):
+        # Wake up for the next cursor blink
+        return max((0.5 - self.cursor_timer) * 1000, 0)
+
+    def GetBounds(self):
+        return (self.x - 1, self.y - 1, self.width + 2, self.font.ch_h + 2)
 
     def Draw(self, elapsed):
         engine2D.DrawBlock(self.x, self.y, self.width, self.font.ch_h, 0, 0, 0, True)
@@ -444,6 +822,8 @@ class TextBox(engine2D.Object):
 # font - font to be used by the console, can be BitmapFont or TrueTypeFont
 # input_callback - a function that takes a int and a string as an argument
 # called every time the user presses enter
+# scrollback_lines - maximum number of lines that scrolled off the console kept
+# for viewing with PG_UP/PG_DOWN
 
 # def input_callback(id, str):
 #       pass
@@ -451,7 +831,7 @@ class TextBox(engine2D.Object):
 # Here "id" is the id of the console object. str is the line inputted to console
 
 class Console(engine2D.Object):
-    def __init__(self, x, y, w, h, font, input_callback):
+    def __init__(self, x, y, w, h, font, input_callback, scrollback_lines=1000):
         super().__init__()
         self.x = x
         self.y = y
@@ -465,8 +845,19 @@ class Console(engine2D.Object):
         self.console_w = int(self.w / font.ch_w) - 1
         self.console_x = 0
         self.console_y = 0
-        self.console_data = [[' ' for _ in range(0, self.console_w)] for _ in range(0,self.console_h)]
-    
+
+        # The screen buffer is a ring buffer of rows, console_top is the index of
+        # the row shown at the top of the console. Scrolling up just advances it.
+        self.console_rows = [[' '] * self.console_w for _ in range(0, self.console_h)]
+        self.console_top = 0
+        # (text, surface) of each row, as rendered by the font. None if the row has
+        # changed since it was last drawn.
+        self.row_cache = [None] * self.console_h
+
+        # Lines that scrolled off the top, oldest first. scroll_offset is how many
+        # lines the view is scrolled back into it (0 shows the live console)
+        self.scrollback = deque(maxlen=scrollback_lines)
+        self.scroll_offset = 0
 
         # Input related functions
         self.input_callback = input_callback
@@ -486,6 +877,14 @@ class Console(engine2D.Object):
         if(self.cursor_timer >= self.cursor_blink_interval):
             self.cursor_timer = 0
             self.cursor_on = not self.cursor_on
+            self.MarkDirty()
+
+    def NextUpdate(self):
+        # Wake up for the next cursor blink
+        return max((self.cursor_blink_interval - self.cursor_timer) * 1000, 0)
+
+    def GetBounds(self):
+        return (self.x - 2, self.y - 2, self.w + 2, self.h + 2)
 
     def GetInput(self, prompt):
         self.PutString(prompt)
@@ -495,8 +894,11 @@ class Console(engine2D.Object):
         # When typing make sure the cursor doesn't blink
         self.timer = 0
         self.cursor_on = True
+        self.MarkDirty()
         # Keyboard handler
         if(self.should_take_input):
+            # Typing jumps back to the live console
+            self.scroll_offset = 0
             # If received newline, this is the end of the line
             if(c == '\n'):
                 self.PutChar('\n')
@@ -512,22 +914,52 @@ class Console(engine2D.Object):
                 self.input_string += c
                 self.PutChar(c)
 
-    def ScrollUp(self):
-        for k in range(0, self.console_h - 1):
-            self.console_data[k] = [c for c in self.console_data[k+1]]
+    # Returns the index in console_rows of the row shown on line y of the console
+    def _RowIndex(self, y):
+        return (self.console_top + y) % self.console_h
+
+    def _SetCell(self, x, y, c):
+        row = self._RowIndex(y)
+        self.console_rows[row][x] = c
+        self.row_cache[row] = None
+
+    # Returns the text of line y of the console
+    def GetLine(self, y):
+        return ''.join(self.console_rows[self._RowIndex(y)])
 
-        for k in range(0, self.console_w):
-            self.console_data[self.console_h - 1][k] = ' '
+    # Scrolls the view back by the given number of lines (forward if negative)
+    def ScrollBack(self, lines):
+        self.scroll_offset = min(max(self.scroll_offset + lines, 0), len(self.scrollback))
+        self.MarkDirty()
+
+    def OnKeyPress(self, elapsed, key):
+        if(key == engine2D.Button.PG_UP):
+            self.ScrollBack(self.console_h)
+        elif(key == engine2D.Button.PG_DOWN):
+            self.ScrollBack(-self.console_h)
+
+    def ScrollUp(self):
+        # The top row goes to the scrollback and becomes the new (blank) bottom row
+        row = self.console_top
+        if(self.scrollback.maxlen != 0):
+            self.scrollback.append(''.join(self.console_rows[row]).rstrip())
+            # Keep a scrolled back view on the same lines
+            if(self.scroll_offset > 0):
+                self.scroll_offset = min(self.scroll_offset + 1, len(self.scrollback))
+        self.console_rows[row] = [' '] * self.console_w
+        self.row_cache[row] = None
+        self.console_top = (self.console_top + 1) % self.console_h
         
         self.console_y = self.console_h - 1
         self.console_x = 0
     
     def PutChar(self, c):
+        self.MarkDirty()
         if(c == '\n'):
             self.console_x = 0
             self.console_y += 1
         else:
-            self.console_data[self.console_y][self.console_x] = c
+            self._SetCell(self.console_x, self.console_y, c)
             self.console_x += 1
 
         if(self.console_x >= self.console_w):
@@ -537,8 +969,45 @@ class Console(engine2D.Object):
         # shift up the console since the old text has to be replaced.
         if(self.console_y >= self.console_h):
             self.ScrollUp()
+
+    def _NewLine(self):
+        self.console_x = 0
+        self.console_y += 1
+        if(self.console_y >= self.console_h):
+            self.ScrollUp()
+    
+    # Writes text to the console a whole line at a time, wrapping lines longer
+    # than the console. Much faster than PutChar for large amounts of text.
+    def Write(self, text):
+        self.MarkDirty()
+        # Only the last console_h + scrollback rows of a long line survive,
+        # rows before that would be scrolled out of the scrollback anyway.
+        kept_rows = None
+        if(self.scrollback.maxlen != None):
+            kept_rows = self.console_h + self.scrollback.maxlen
+        for i, line in enumerate(text.split('\n')):
+            if(i > 0):
+                self._NewLine()
+            
+            pos = 0
+            while(pos < len(line)):
+                if(self.console_x == 0 and kept_rows != None):
+                    skipped_rows = (len(line) - pos) // self.console_w - kept_rows
+                    if(skipped_rows > 0):
+                        pos += skipped_rows * self.console_w
+                # Fill the rest of the current row
+                n = min(len(line) - pos, self.console_w - self.console_x)
+                row = self._RowIndex(self.console_y)
+                self.console_rows[row][self.console_x : self.console_x + n] = line[pos : pos + n]
+                self.row_cache[row] = None
+                self.console_x += n
+                pos += n
+
+                if(self.console_x >= self.console_w):
+                    self._NewLine()
     
     def UnPutChar(self):
+        self.MarkDirty()
         self.console_x -= 1
         if(self.console_x < 0):
             self.console_x = self.console_w - 1
@@ -547,19 +1016,20 @@ class Console(engine2D.Object):
         if(self.console_y < 0):
             return
         
-        self.console_data[self.console_y][self.console_x] = ' '
+        self._SetCell(self.console_x, self.console_y, ' ')
 
     def PutString(self, s):
-        for c in s:
-            self.PutChar(c)
+        self.Write(s)
 
 
     def Clear(self):
+        self.MarkDirty()
         self.console_x = 0
         self.console_y = 0
-        for y in range(0, self.console_h):
-            for x in range(0, self.console_w):
-                self.console_data[y][x] = ' '
+        self.console_rows = [[' '] * self.console_w for _ in range(0, self.console_h)]
+        self.console_top = 0
+        self.row_cache = [None] * self.console_h
+        self.scroll_offset = 0
     
     def Draw(self, elapsed):
         # Draw a block around the console
@@ -570,11 +1040,33 @@ class Console(engine2D.Object):
         
         # Draw the console images
 
-        # Draw the console characters
-        for x in range(0, self.console_w):
-            for y in range(0, self.console_h):
-                self.font.PutChar(self.console_data[y][x], self.x + x * self.font.ch_w, self.y + y * self.font.ch_h)
+        # Draw the console rows. Each row is rendered once by the font when it changes,
+        # and all of them are blitted in one batch. Blank rows are skipped.
+        blit_sequence = []
+        text_lines = []
+        for y in range(0, self.console_h):
+            line = y - self.scroll_offset
+            if(line < 0):
+                # Scrolled back, this line comes from the scrollback
+                text_lines.append((self.scrollback[line], self.x, self.y + y * self.font.ch_h))
+                continue
+
+            row = self._RowIndex(line)
+            if(self.row_cache[row] == None):
+                text = ''.join(self.console_rows[row]).rstrip()
+                self.row_cache[row] = (text, self.font.RenderString(text) if text != '' else None)
+            
+            text, surface = self.row_cache[row]
+            if(surface != None):
+                sx, sy = engine2D.current_viewport.ToScreen(self.x, self.y + y * self.font.ch_h)
+                blit_sequence.append((surface, (round(sx), round(sy))))
+            elif(text != ''):
+                # The font can't render off-screen, draw the text directly
+                text_lines.append((text, self.x, self.y + y * self.font.ch_h))
+        
+        engine2D.GetScreenSurface().blits(blit_sequence, False)
+        self.font.PutStrings(text_lines)
         
         # Print the cursor if the flag is ON (the flag is toggled in update)
-        if(self.cursor_on):
-            engine2D.DrawBlock(self.x + self.console_x * self.font.ch_w, self.y + self.console_y * self.font.ch_h, self.font.ch_w, self.font.ch_h, 255, 255, 255, True)
\ No newline at end of file
+        if(self.cursor_on and self.console_y + self.scroll_offset < self.console_h):
+            engine2D.DrawBlock(self.x + self.console_x * self.font.ch_w, self.y + (self.console_y + self.scroll_offset) * self.font.ch_h, self.font.ch_w, self.font.ch_h, 255, 255, 255, True)
\ No newline at end of file
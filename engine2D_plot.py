@@ -4,6 +4,8 @@ import pygame
 import engine2D
 import numpy as np
 import math
+import types
+from collections import OrderedDict
 
 class Point:
     def __init__(self, x, y, z=1):
@@ -46,6 +48,108 @@ def ScreenToCartesian(px, py, x, y, w, h, x_start, x_end, y_start, y_end):
     y_origin_screen = (y + h*0.5)
     return (((px - x_origin_screen) / x_scale) + x_origin_plotset, (-(py - y_origin_screen) / y_scale) + y_origin_plotset)
 
+# Draws the x and y axes of a plot space, clamped to its edges
+def DrawAxes(x, y, w, h, x_start, x_end, y_start, y_end):
+    y_axis, x_axis = CartesianToScreen(0, 0, x, y, w, h, x_start, x_end, y_start, y_end)
+    if(x_axis < y): x_axis = y
+    if(y_axis < x): y_axis = x
+    if(x_axis > y + h): x_axis = y + h
+    if(y_axis > x + w): y_axis = x + w
+
+    engine2D.DrawLine(y_axis, y, y_axis, y+h, 32, 32, 192)
+    engine2D.DrawLine(x, x_axis, x+w, x_axis, 32, 32, 192)
+
+# Returns evenly spaced tick values between start and end, with at most max_ticks steps
+# of 1, 2 or 5 times a power of ten between them
+def NiceTicks(start, end, max_ticks):
+    if(end <= start or max_ticks < 1):
+        return []
+    raw_step = (end - start) / max_ticks
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    for m in (1, 2, 5, 10):
+        step = m * magnitude
+        if(step >= raw_step):
+            break
+    
+    # Round the ticks to the precision of the step to avoid labels like 0.30000000000000004
+    digits = max(0, -math.floor(math.log10(step)))
+    return [round(k * step, digits) for k in range(math.ceil(start / step), math.floor(end / step) + 1)]
+
+# Plot background layer
+# Draws the grid, the axes and the tick labels of a plot once into a RenderTarget,
+# and then only blits it, until the plot ranges or size change.
+# font - engine2D.Font used for the tick labels, None for no labels
+# tick_spacing - minimum distance between ticks, in pixels
+class PlotBackground:
+    def __init__(self, font=None, grid=True, axes=True, tick_spacing=64, back_color=(0, 0, 0), grid_color=(48, 48, 48), axes_color=(32, 32, 192)):
+        self.font = font
+        self.grid = grid
+        self.axes = axes
+        self.tick_spacing = tick_spacing
+        self.back_color = back_color
+        self.grid_color = grid_color
+        self.axes_color = axes_color
+
+        self.target = None
+        # (w, h, x_start, x_end, y_start, y_end) of the rendered layer
+        self.layer_key = None
+        self.render_count = 0
+
+    def Render(self, w, h, x_start, x_end, y_start, y_end):
+        if(self.target == None or self.target.w != w or self.target.h != h):
+            self.target = engine2D.RenderTarget(int(w), int(h))
+        self.render_count += 1
+
+        # Draw into the layer in its own coordinates
+        previous_surface = engine2D.GetScreenSurface()
+        previous_viewport = engine2D.GetViewport()
+        engine2D.SetRenderTarget(self.target)
+        engine2D.SetViewport(engine2D.Viewport(0, 0, w, h))
+
+        engine2D.Clear(*self.back_color)
+        x_ticks = NiceTicks(x_start, x_end, int(w / self.tick_spacing))
+        y_ticks = NiceTicks(y_start, y_end, int(h / self.tick_spacing))
+        
+        if(self.grid):
+            for tick in x_ticks:
+                tx = CartesianToScreen(tick, 0, 0, 0, w, h, x_start, x_end, y_start, y_end)[0]
+                engine2D.DrawLine(tx, 0, tx, h, *self.grid_color)
+            for tick in y_ticks:
+                ty = CartesianToScreen(0, tick, 0, 0, w, h, x_start, x_end, y_start, y_end)[1]
+                engine2D.DrawLine(0, ty, w, ty, *self.grid_color)
+        
+        if(self.axes):
+            y_axis, x_axis = CartesianToScreen(0, 0, 0, 0, w, h, x_start, x_end, y_start, y_end)
+            y_axis = min(max(y_axis, 0), w - 1)
+            x_axis = min(max(x_axis, 0), h - 1)
+            engine2D.DrawLine(y_axis, 0, y_axis, h, *self.axes_color)
+            engine2D.DrawLine(0, x_axis, w, x_axis, *self.axes_color)
+        
+        if(self.font):
+            # x labels along the bottom edge, y labels along the left edge
+            for tick in x_ticks:
+                label = '%g' % tick
+                tx = CartesianToScreen(tick, 0, 0, 0, w, h, x_start, x_end, y_start, y_end)[0]
+                tx = min(max(tx + 2, 0), w - len(label) * self.font.ch_w)
+                self.font.PutString(label, tx, h - self.font.ch_h)
+            for tick in y_ticks:
+                ty = CartesianToScreen(0, tick, 0, 0, w, h, x_start, x_end, y_start, y_end)[1]
+                ty = min(max(ty - self.font.ch_h, 0), h - 2 * self.font.ch_h)
+                self.font.PutString('%g' % tick, 2, ty)
+        
+        engine2D.SetViewport(previous_viewport)
+        engine2D.screen_surface = previous_surface
+
+    # Draws the layer at (x, y), re-rendering it first if the plot changed
+    def Draw(self, x, y, w, h, x_start, x_end, y_start, y_end):
+        key = (w, h, x_start, x_end, y_start, y_end)
+        if(key != self.layer_key):
+            self.Render(w, h, x_start, x_end, y_start, y_end)
+            self.layer_key = key
+        
+        sx, sy = engine2D.current_viewport.ToScreen(x, y)
+        self.target.DrawTarget(sx, sy)
+
 # Plots a set of points on the screen in a given screen space
 # Here
 # pts - point list of plots to plot
@@ -53,7 +157,13 @@ def ScreenToCartesian(px, py, x, y, w, h, x_start, x_end, y_start, y_end):
 # w,h - the dimensions of the plot space on scren
 # x_start,y_start - which co-ordinate to start plotting from in the given Point collection
 # x_end,y_end - final co-ordinates
-def PlotPoints(pts, x, y, w, h, x_start, x_end, y_start, y_end, type='LINE', axes=True):
+# background - PlotBackground drawn under the points, replaces the plain axes
+def PlotPoints(pts, x, y, w, h, x_start, x_end, y_start, y_end, type='LINE', axes=True, background=None):
+    # Scatter plots and dense lines are drawn in bulk by PlotArrays
+    if(type == 'SCATTER' or (type == 'LINE' and len(pts) > 4 * w)):
+        PlotArrays([pt.x for pt in pts], [pt.y for pt in pts], x, y, w, h, x_start, x_end, y_start, y_end, type, axes, background=background)
+        return
+
     # We need to scale the Cartesian co-ordinates into screen space
     x_scale = (w) / (x_end - x_start)
     y_scale = (h) / (y_end - y_start)
@@ -70,16 +180,10 @@ def PlotPoints(pts, x, y, w, h, x_start, x_end, y_start, y_end, type='LINE', axe
     ox = nan
     oy = nan
 
-    if(axes):
-        y_axis = x_origin_screen - x_origin * x_scale
-        x_axis = y_origin_screen + y_origin * y_scale
-        if(x_axis < y): x_axis = y
-        if(y_axis < x): y_axis = x
-        if(x_axis > y + h): x_axis = y + h
-        if(y_axis > x + w): y_axis = x + w
-
-        engine2D.DrawLine(y_axis, y, y_axis, y+h, 32, 32, 192)
-        engine2D.DrawLine(x, x_axis, x+w, x_axis, 32, 32, 192)
+    if(background):
+        background.Draw(x, y, w, h, x_start, x_end, y_start, y_end)
+    elif(axes):
+        DrawAxes(x, y, w, h, x_start, x_end, y_start, y_end)
 
 
     for i in range(0, len(pts)):
@@ -99,16 +203,453 @@ def PlotPoints(pts, x, y, w, h, x_start, x_end, y_start, y_end, type='LINE', axe
             elif(type == 'LINE'):
                 if(not math.isnan(ox)):
                     #engine2D.DrawLine(ox, oy, px, py, 255, 255, 255)
-                    pygame.draw.aaline(engine2D.GetScreenSurface(), (255, 255, 255), (ox, oy) ,(px, py), 2)
+                    pygame.draw.aaline(engine2D.GetScreenSurface(), (255, 255, 255), engine2D.current_viewport.ToScreen(ox, oy), engine2D.current_viewport.ToScreen(px, py), 2)
                 
                 ox = px
                 oy = py
     
+# Reduces a line given in screen space to at most four points per pixel column:
+# the first, last, lowest and highest points of the column, in their original order.
+# The line drawn through the remaining points covers the same pixels.
+# px, py - NumPy arrays of the screen co-ordinates of the line
+# returns the decimated (px, py)
+def DecimateMinMax(px, py):
+    n = len(px)
+    if(n == 0):
+        return px, py
+    
+    # Split the points into runs of consecutive points in the same pixel column
+    column = np.floor(px).astype(np.intp)
+    starts = np.flatnonzero(np.concatenate(([True], column[1:] != column[:-1])))
+    ends = np.concatenate((starts[1:], [n])) - 1
+    run_lengths = ends - starts + 1
+    run = np.repeat(np.arange(len(starts)), run_lengths)
+
+    # The first point of each run reaching the lowest and highest value of its run
+    lowest = np.repeat(np.minimum.reduceat(py, starts), run_lengths)
+    highest = np.repeat(np.maximum.reduceat(py, starts), run_lengths)
+    lowest_idx = np.flatnonzero(py == lowest)
+    highest_idx = np.flatnonzero(py == highest)
+    lowest_idx = lowest_idx[np.unique(run[lowest_idx], return_index=True)[1]]
+    highest_idx = highest_idx[np.unique(run[highest_idx], return_index=True)[1]]
+
+    keep = np.unique(np.concatenate((starts, ends, lowest_idx, highest_idx)))
+    return px[keep], py[keep]
+
+# Same as PlotPoints, but the points are given as NumPy arrays and transformed,
+# clipped and drawn as a whole. Much faster for large numbers of points.
+# Here
+# xs, ys - arrays (or sequences) of the Cartesian co-ordinates of the points
+# color - colour of the plot
+# lod - for lines with many more points than pixel columns, only draw the points
+# that make a difference (see DecimateMinMax), so that the cost is bounded by w
+# background - PlotBackground drawn under the points, replaces the plain axes
+def PlotArrays(xs, ys, x, y, w, h, x_start, x_end, y_start, y_end, type='LINE', axes=True, color=(255, 255, 255), lod=True, background=None):
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+
+    if(background):
+        background.Draw(x, y, w, h, x_start, x_end, y_start, y_end)
+    elif(axes):
+        DrawAxes(x, y, w, h, x_start, x_end, y_start, y_end)
+
+    # Transform all the points to screen space at once
+    px, py = CartesianToScreen(xs, ys, x, y, w, h, x_start, x_end, y_start, y_end)
+    
+    # Only keep the points within the plot range and the screen bounds
+    visible = (xs >= x_start) & (xs <= x_end) & (px > x) & (py > y) & (px < (x+w)) & (py < (y+h))
+    px = px[visible]
+    py = py[visible]
+
+    if(type == 'SCATTER'):
+        engine2D.DrawPixels(px, py, color)
+    elif(type == 'LINE'):
+        # Apply the viewport
+        px -= engine2D.current_viewport.x
+        py -= engine2D.current_viewport.y
+        surface = engine2D.GetScreenSurface()
+        if(lod and len(px) > 4 * w):
+            px, py = DecimateMinMax(px, py)
+        if(len(px) >= 2):
+            pygame.draw.aalines(surface, color, False, np.column_stack((px, py)).tolist())
+
+# Caches of PlotFunction, both least recently used first
+# sampled_curves - key -> (xs, ys) of the sampled function
+# curve_layers - key -> rendered curve, as a pygame Surface with per-pixel alpha
+FUNCTION_CACHE_SIZE = 32
+sampled_curves = OrderedDict()
+curve_layers = OrderedDict()
+
+# Returns a key for what f computes. A lambda created anew every frame has the
+# same code, defaults, closure values and global values each time, so it gets the same key.
+# Builtins and NumPy ufuncs (like math.sin or np.sin) are identified by the object itself.
+# Returns None if f can't be keyed: other callables, and functions using unhashable
+# values, may compute something else every time, so they are not cached.
+# Note: changes inside the objects f uses (like attributes) are not seen, plot
+# functions depending on those with cache=False
+def _FunctionKey(f):
+    if(isinstance(f, (types.BuiltinFunctionType, np.ufunc))):
+        return f
+    if(not isinstance(f, types.FunctionType)):
+        return None
+    try:
+        closure = tuple(cell.cell_contents for cell in f.__closure__) if f.__closure__ else ()
+        used_globals = tuple((name, f.__globals__[name]) for name in f.__code__.co_names if name in f.__globals__)
+        key = (f.__code__, f.__defaults__, closure, used_globals)
+        hash(key)
+    except (TypeError, ValueError):
+        return None
+    return key
+
+# Evaluates f at all the points of xs, in a single call if f accepts NumPy arrays
+# (like np.sin or lambda x: x**2), otherwise one call per point
+def _Evaluate(f, xs):
+    try:
+        with np.errstate(all='ignore'):
+            ys = np.asarray(f(xs), dtype=np.float64)
+        if(ys.shape == xs.shape):
+            return ys
+    except (TypeError, ValueError):
+        pass
+    return np.array([f(px) for px in xs], dtype=np.float64)
+
+# Samples f on [xmin, xmax] for a plot of w x h pixels showing ymin to ymax.
+# Starts with a sample every 4 pixels, then keeps halving the intervals whose
+# midpoint is more than tolerance pixels off the straight line between their ends,
+# down to a quarter of a pixel. Intervals where f stops or starts being finite
+# are halved too, so that poles and the edges of its domain are found.
+# returns (xs, ys) as NumPy arrays
+def SampleAdaptive(f, xmin, xmax, w, h, ymin, ymax, tolerance=0.5):
+    x_scale = w / (xmax - xmin)
+    y_scale = h / (ymax - ymin)
+    xs = np.linspace(xmin, xmax, max(int(w / 4), 1) + 1)
+    ys = _Evaluate(f, xs)
+
+    # The intervals (between xs[i] and xs[i+1]) that may still need halving
+    active = np.ones(len(xs) - 1, dtype=bool)
+    while(True):
+        candidates = np.flatnonzero(active & ((xs[1:] - xs[:-1]) * x_scale > 0.25))
+        if(len(candidates) == 0):
+            break
+        
+        mid_x = (xs[candidates] + xs[candidates + 1]) / 2
+        mid_y = _Evaluate(f, mid_x)
+        left = ys[candidates]
+        right = ys[candidates + 1]
+        with np.errstate(invalid='ignore'):
+            error = np.abs(mid_y - (left + right) / 2) * y_scale
+        finite_mid = np.isfinite(mid_y)
+        split = (error > tolerance) | (np.isfinite(left) != finite_mid) | (finite_mid != np.isfinite(right))
+
+        # Both halves of a split interval stay active, the others are done
+        split_idx = candidates[split]
+        active[candidates] = False
+        active[split_idx] = True
+        xs = np.insert(xs, split_idx + 1, mid_x[split])
+        ys = np.insert(ys, split_idx + 1, mid_y[split])
+        active = np.insert(active, split_idx + 1, True)
+    
+    return xs, ys
+
+# Samples f for PlotFunction, uniformly every step or adaptively
+def _SampleFunction(f, w, h, xmin, xmax, ymin, ymax, step, adaptive, tolerance):
+    if(adaptive):
+        return SampleAdaptive(f, xmin, xmax, w, h, ymin, ymax, tolerance)
+    xs = np.arange(xmin, xmax, step)
+    return xs, _Evaluate(f, xs)
+
+# Draws a sampled curve into a layer of w x h pixels.
+# The curve is drawn over black and its brightness becomes the alpha of a layer
+# of the curve colour, so its antialiased edges blend over whatever is under the plot.
+def _RenderCurve(xs, ys, w, h, xmin, xmax, ymin, ymax, color):
+    target = engine2D.RenderTarget(int(math.ceil(w)), int(math.ceil(h)))
+    previous_surface = engine2D.GetScreenSurface()
+    previous_viewport = engine2D.GetViewport()
+    engine2D.SetRenderTarget(target)
+    engine2D.SetViewport(engine2D.Viewport(0, 0, target.w, target.h))
+    PlotArrays(xs, ys, 0, 0, w, h, xmin, xmax, ymin, ymax, 'LINE', False, color)
+    engine2D.SetViewport(previous_viewport)
+    engine2D.screen_surface = previous_surface
+
+    brightness = pygame.surfarray.array3d(target.render_surface).max(axis=2).astype(np.int32)
+    layer = pygame.Surface((target.w, target.h), pygame.SRCALPHA)
+    layer.fill(tuple(color) + (0,))
+    alpha = pygame.surfarray.pixels_alpha(layer)
+    alpha[:] = np.minimum(brightness * 255 // max(max(color), 1), 255)
+    del alpha
+    return layer
+
 # Directly creates a plot and plots it
 # x,y,w,h - screen space to plot the function
-# f - the function itself, must return a double.
+# f - the function itself, must return a double. Functions that work on NumPy arrays
+# are evaluated at all the points in one call.
 # xmin,ymin - minimum xcoordinates
 # xmax,ymax - maximum ycoordinates
 # step - distance between two x points 0.1 by default
-def PlotFunction(f, x, y, w, h, xmin, xmax, ymin, ymax, step=0.1, axes=True):
-    PlotPoints([Point(x, f(x)) for x in np.arange(xmin, xmax, step)], x, y, w, h, xmin, xmax, ymin, ymax, 'LINE', axes)
\ No newline at end of file
+# background - PlotBackground drawn under the function, replaces the plain axes
+# adaptive - ignore step and sample f more densely where it bends, see SampleAdaptive
+# tolerance - maximum error of the adaptive samples, in pixels
+# cache - keep the samples and the drawn curve for the next calls with the same
+# function and plot (see _FunctionKey), so that a static plot costs a single blit
+def PlotFunction(f, x, y, w, h, xmin, xmax, ymin, ymax, step=0.1, axes=True, background=None, adaptive=False, tolerance=0.5, color=(255, 255, 255), cache=True):
+    if(adaptive):
+        resolution = (w, h, ymin, ymax, tolerance)
+    else:
+        resolution = step
+    
+    function_key = _FunctionKey(f) if cache else None
+    if(function_key == None):
+        xs, ys = _SampleFunction(f, w, h, xmin, xmax, ymin, ymax, step, adaptive, tolerance)
+        PlotArrays(xs, ys, x, y, w, h, xmin, xmax, ymin, ymax, 'LINE', axes, color, background=background)
+        return
+    
+    sample_key = (function_key, xmin, xmax, adaptive, resolution)
+    layer_key = (sample_key, w, h, ymin, ymax, tuple(color))
+    if(layer_key in curve_layers):
+        curve_layers.move_to_end(layer_key)
+        layer = curve_layers[layer_key]
+    else:
+        if(sample_key in sampled_curves):
+            sampled_curves.move_to_end(sample_key)
+            xs, ys = sampled_curves[sample_key]
+        else:
+            xs, ys = _SampleFunction(f, w, h, xmin, xmax, ymin, ymax, step, adaptive, tolerance)
+            sampled_curves[sample_key] = (xs, ys)
+            if(len(sampled_curves) > FUNCTION_CACHE_SIZE):
+                sampled_curves.popitem(last=False)
+        
+        layer = _RenderCurve(xs, ys, w, h, xmin, xmax, ymin, ymax, color)
+        curve_layers[layer_key] = layer
+        if(len(curve_layers) > FUNCTION_CACHE_SIZE):
+            curve_layers.popitem(last=False)
+    
+    if(background):
+        background.Draw(x, y, w, h, xmin, xmax, ymin, ymax)
+    elif(axes):
+        DrawAxes(x, y, w, h, xmin, xmax, ymin, ymax)
+    engine2D.GetScreenSurface().blit(layer, engine2D.current_viewport.ToScreen(x, y))
+
+# Forgets the samples and the drawn curves kept by PlotFunction
+def ClearFunctionCache():
+    sampled_curves.clear()
+    curve_layers.clear()
+
+# Streaming plot object
+# Plots a live stream of samples kept in a fixed-capacity ring buffer.
+# The x range scrolls with the newest samples and the y range grows to fit
+# the samples in the buffer (and shrinks back when the extremes are overwritten).
+# x,y,w,h - screen space of the plot
+# capacity - maximum number of samples kept
+# x_window - width of the x range shown, None to show all the samples in the buffer
+# y_start,y_end - initial y range, fixed if auto_scale is False
+# background - PlotBackground drawn under the samples, replaces the plain axes
+class StreamingPlot(engine2D.Object):
+    # Samples per block of the first level of the min/max pyramid
+    BLOCK_SIZE = 64
+
+    def __init__(self, x, y, w, h, capacity, x_window=None, y_start=-1, y_end=1, auto_scale=True, type='LINE', axes=True, color=(255, 255, 255), background=None):
+        super().__init__()
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.x_window = x_window
+        self.y_start = y_start
+        self.y_end = y_end
+        self.auto_scale = auto_scale
+        self.type = type
+        self.axes = axes
+        self.color = color
+        self.background = background
+
+        # Ring buffer, head is where the next sample goes
+        # The x values of the samples are expected to be increasing
+        self.capacity = capacity
+        self.xs = np.zeros(capacity)
+        self.ys = np.zeros(capacity)
+        self.head = 0
+        self.count = 0
+
+        # Min/max pyramid of the buffer. Level j splits the buffer in blocks of
+        # BLOCK_SIZE * 2**j samples and keeps, for every block, the lowest and highest
+        # finite y and their indices: (lo, hi, lo_idx, hi_idx). Blocks without finite
+        # samples have lo = inf and hi = -inf. The last level is a single block.
+        n_blocks = 1
+        while(n_blocks * self.BLOCK_SIZE < capacity):
+            n_blocks *= 2
+        self.levels = []
+        while(n_blocks >= 1):
+            self.levels.append((np.full(n_blocks, math.inf), np.full(n_blocks, -math.inf), np.zeros(n_blocks, dtype=np.intp), np.zeros(n_blocks, dtype=np.intp)))
+            n_blocks //= 2
+
+        # Range of the samples in the buffer, the last level of the pyramid
+        self.y_min = math.inf
+        self.y_max = -math.inf
+
+    # Recomputes the blocks of the pyramid covering the samples [start, stop)
+    # Costs O(stop - start + BLOCK_SIZE + number of levels)
+    def _UpdateLevels(self, start, stop):
+        first = start // self.BLOCK_SIZE
+        last = (stop - 1) // self.BLOCK_SIZE + 1
+        
+        # The first level is computed from the live samples, padded to whole blocks
+        a = first * self.BLOCK_SIZE
+        b = min(last * self.BLOCK_SIZE, self.count)
+        finite = np.isfinite(self.ys[a:b])
+        padding = (0, (last - first) * self.BLOCK_SIZE - (b - a))
+        low = np.pad(np.where(finite, self.ys[a:b], math.inf), padding, constant_values=math.inf).reshape(-1, self.BLOCK_SIZE)
+        high = np.pad(np.where(finite, self.ys[a:b], -math.inf), padding, constant_values=-math.inf).reshape(-1, self.BLOCK_SIZE)
+        low_arg = low.argmin(axis=1)
+        high_arg = high.argmax(axis=1)
+        blocks = np.arange(last - first)
+        lo, hi, lo_idx, hi_idx = self.levels[0]
+        lo[first:last] = low[blocks, low_arg]
+        hi[first:last] = high[blocks, high_arg]
+        lo_idx[first:last] = a + blocks * self.BLOCK_SIZE + low_arg
+        hi_idx[first:last] = a + blocks * self.BLOCK_SIZE + high_arg
+
+        # Every block of the next levels merges two blocks of the level below
+        for j in range(1, len(self.levels)):
+            first //= 2
+            last = (last + 1) // 2
+            child_lo, child_hi, child_lo_idx, child_hi_idx = self.levels[j - 1]
+            left = slice(2 * first, 2 * last, 2)
+            right = slice(2 * first + 1, 2 * last, 2)
+            lo, hi, lo_idx, hi_idx = self.levels[j]
+            take_right = child_lo[right] < child_lo[left]
+            lo[first:last] = np.where(take_right, child_lo[right], child_lo[left])
+            lo_idx[first:last] = np.where(take_right, child_lo_idx[right], child_lo_idx[left])
+            take_right = child_hi[right] > child_hi[left]
+            hi[first:last] = np.where(take_right, child_hi[right], child_hi[left])
+            hi_idx[first:last] = np.where(take_right, child_hi_idx[right], child_hi_idx[left])
+
+    # Appends a batch of samples, costs O(len(xs))
+    def Append(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64).ravel()
+        ys = np.asarray(ys, dtype=np.float64).ravel()
+        # Only the newest samples fit
+        if(len(xs) > self.capacity):
+            xs = xs[-self.capacity:]
+            ys = ys[-self.capacity:]
+        n = len(xs)
+        if(n == 0):
+            return
+
+        # The samples are written in (at most) two slices, wrapping around the end
+        first = min(n, self.capacity - self.head)
+        slices = [(slice(self.head, self.head + first), slice(0, first)), (slice(0, n - first), slice(first, n))]
+        for buffer_slice, data_slice in slices:
+            if(buffer_slice.stop == buffer_slice.start):
+                continue
+            # The buffer fills up from index 0, so the samples in [0, count) are live
+            self.xs[buffer_slice] = xs[data_slice]
+            self.ys[buffer_slice] = ys[data_slice]
+            self.count = max(self.count, buffer_slice.stop)
+            self._UpdateLevels(buffer_slice.start, buffer_slice.stop)
+        
+        self.head = (self.head + n) % self.capacity
+
+        lo, hi, lo_idx, hi_idx = self.levels[-1]
+        self.y_min = lo[0]
+        self.y_max = hi[0]
+        
+        self.MarkDirty()
+
+    def Clear(self):
+        self.head = 0
+        self.count = 0
+        for lo, hi, lo_idx, hi_idx in self.levels:
+            lo.fill(math.inf)
+            hi.fill(-math.inf)
+        self.y_min = math.inf
+        self.y_max = -math.inf
+        self.MarkDirty()
+
+    # Returns the samples in the buffer, oldest first
+    def GetSamples(self):
+        if(self.count < self.capacity):
+            return self.xs[:self.count], self.ys[:self.count]
+        return np.concatenate((self.xs[self.head:], self.xs[:self.head])), np.concatenate((self.ys[self.head:], self.ys[:self.head]))
+
+    # Returns the ranges of the buffer holding the samples, oldest first
+    # Once the buffer is full, the samples wrap around its end
+    def _GetRuns(self):
+        if(self.count < self.capacity):
+            return [(0, self.count)]
+        return [(self.head, self.capacity), (0, self.head)]
+
+    def _UpdateRanges(self):
+        runs = self._GetRuns()
+        x_end = self.xs[(self.head - 1) % self.capacity]
+        x_start = x_end - self.x_window if self.x_window != None else self.xs[runs[0][0]]
+        if(x_end <= x_start):
+            x_start = x_end - 1
+
+        if(self.auto_scale):
+            if(self.y_min <= self.y_max):
+                # Leave a margin so the extremes aren't drawn on the edges
+                margin = (self.y_max - self.y_min) * 0.05
+                if(margin == 0):
+                    margin = 1
+                self.y_start = self.y_min - margin
+                self.y_end = self.y_max + margin
+        
+        return x_start, x_end
+
+    # Returns the indices of the samples to draw out of the range [start, stop) of the buffer.
+    # With level None these are all the samples. Otherwise the range is split in the
+    # largest blocks of the pyramid (up to the given level) that fit, and only the lowest
+    # and highest sample of each block are drawn. Only the samples before the first
+    # block and after the last one are taken one by one.
+    def _GetSampleIndices(self, start, stop, level):
+        if(level == None):
+            return np.arange(start, stop)
+
+        pieces = []
+        i = min(-(-start // self.BLOCK_SIZE) * self.BLOCK_SIZE, stop)
+        pieces.append(np.arange(start, i))
+        while(i + self.BLOCK_SIZE <= stop):
+            # Go up the levels while i is the start of a block and the block fits
+            j = 0
+            while(j < level and (i // self.BLOCK_SIZE) % (2 << j) == 0 and i + (self.BLOCK_SIZE << (j + 1)) <= stop):
+                j += 1
+            size = self.BLOCK_SIZE << j
+            n_blocks = (stop - i) // size if j == level else 1
+            
+            lo, hi, lo_idx, hi_idx = self.levels[j]
+            blocks = slice(i // size, i // size + n_blocks)
+            not_empty = lo[blocks] <= hi[blocks]
+            pieces.append(lo_idx[blocks][not_empty])
+            pieces.append(hi_idx[blocks][not_empty])
+            i += n_blocks * size
+
+        pieces.append(np.arange(i, stop))
+        return np.unique(np.concatenate(pieces))
+
+    # Only the samples within the x range are drawn. Lines with many samples per pixel
+    # column are drawn through the extremes of blocks of at most half a column
+    # (see _GetSampleIndices), so the cost of drawing a line depends on w, not on the capacity.
+    def Draw(self, elapsed):
+        if(self.count == 0):
+            if(self.background):
+                self.background.Draw(self.x, self.y, self.w, self.h, -1, 1, self.y_start, self.y_end)
+            elif(self.axes):
+                DrawAxes(self.x, self.y, self.w, self.h, -1, 1, self.y_start, self.y_end)
+            return
+        
+        x_start, x_end = self._UpdateRanges()
+        runs = []
+        for start, stop in self._GetRuns():
+            xs = self.xs[start:stop]
+            runs.append((start + np.searchsorted(xs, x_start, 'left'), start + np.searchsorted(xs, x_end, 'right')))
+
+        level = None
+        if(self.type == 'LINE'):
+            per_column = sum(stop - start for start, stop in runs) / self.w
+            size = self.BLOCK_SIZE
+            while(2 * size <= per_column and (level == None or level + 1 < len(self.levels))):
+                level = 0 if level == None else level + 1
+                size *= 2
+        
+        indices = np.concatenate([self._GetSampleIndices(start, stop, level) for start, stop in runs])
+        PlotArrays(self.xs[indices], self.ys[indices], self.x, self.y, self.w, self.h, x_start, x_end, self.y_start, self.y_end, self.type, self.axes, self.color, background=self.background)